@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""Compare the pure-Python and libyaml frontmatter loaders.
+
+Generates a corpus of frontmatter documents and times parsing all of them with each loader
+available. Run with ``python benchmarks/frontmatter.py [number of documents]``.
+"""
+
+# stdlib
+import random
+import sys
+import timeit
+
+# external
+import yaml
+
+# internal
+import phial.documents
+
+
+def make_frontmatter(index, rng):
+    tags = u", ".join(u"tag{0!s}".format(rng.randint(0, 50)) for i in range(rng.randint(1, 8)))
+    return (
+        u"title: Post number {0!s}\n"
+        u"author: Somebody \u00e9\u00e8\n"
+        u"date: 2014-{1:02d}-{2:02d}\n"
+        u"tags: [{3}]\n"
+        u"summary: >\n"
+        u"  {4}\n"
+        u"links:\n"
+        u"  - {{name: home, url: /index.htm}}\n"
+        u"  - {{name: about, url: /about.htm}}\n"
+    ).format(index, rng.randint(1, 12), rng.randint(1, 28), tags, u"lorem ipsum " * 20)
+
+
+def main(args=sys.argv[1:]):
+    count = int(args[0]) if args else 2000
+    rng = random.Random(0)
+    corpus = [make_frontmatter(i, rng) for i in range(count)]
+
+    loaders = [phial.documents.UnicodeSafeLoader]
+    if hasattr(phial.documents, "UnicodeSafeCLoader"):
+        loaders.append(phial.documents.UnicodeSafeCLoader)
+    else:
+        print "PyYAML was built without libyaml, only the pure-Python loader is available."
+
+    baseline = None
+    for loader in loaders:
+        def parse_all():
+            for i in corpus:
+                yaml.load(i, loader)
+
+        seconds = min(timeit.repeat(parse_all, number=1, repeat=3))
+        baseline = baseline or seconds
+        print "{0:<20} {1:8.3f}s for {2!s} documents ({3:.1f}x)".format(
+            loader.__name__, seconds, count, baseline / seconds)
+
+
+if __name__ == "__main__":
+    main()
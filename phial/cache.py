@@ -0,0 +1,142 @@
+# stdlib
+import cPickle as pickle
+import errno
+import hashlib
+import os
+
+# internal
+from . import utils
+
+# set up logging
+import phial.loggers
+log = phial.loggers.get_logger(__name__)
+
+
+class DiskCache(object):
+    """A persistent cache of pickled values, stored as files in a directory.
+
+    Once the cache grows past ``max_size`` bytes the least recently used entries are evicted
+    until it's comfortably below that again. Entries are written atomically so several processes
+    can share a cache safely.
+    """
+
+    # Evicting stops once the cache is this fraction of its maximum size, so we don't have to
+    # evict again on the very next write.
+    EVICTION_RATIO = 0.9
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        # The total size of all the entries, calculated when first needed
+        self._size = None
+
+    def _get_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf_8")
+
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key, default=None):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+        except Exception:
+            log.debug("Removing corrupt cache entry {0}.", path, exc_info=True, exc_ignored=True)
+            self._remove(path)
+            return default
+
+        # Use the modification time to keep track of when the entry was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def set(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+
+        path = self._get_path(key)
+        utils.makedirs(os.path.dirname(path))
+
+        temp_path = "{0}.{1!s}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+        if self._size is None:
+            self._size = sum(size for mtime, size, path in self._get_entries())
+        else:
+            self._size += len(data)
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _get_entries(self):
+        """Return a list of ``(mtime, size, path)`` for every entry in the cache."""
+        entries = []
+        for dirpath, dirs, files in os.walk(self.directory):
+            for i in files:
+                path = os.path.join(dirpath, i)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is small enough."""
+        entries = sorted(self._get_entries())
+        self._size = sum(size for mtime, size, path in entries)
+
+        target_size = self.max_size * self.EVICTION_RATIO
+        evicted = 0
+        for mtime, size, path in entries:
+            if self._size <= target_size:
+                break
+
+            self._remove(path)
+            self._size -= size
+            evicted += 1
+
+        log.debug("Evicted {0!s} entries from the cache at {1}.", evicted, self.directory)
+
+
+# The cache shared by everything in this build, see configure()
+_cache = None
+
+
+def configure(directory, max_size):
+    """Set up the cache that :func:`get_cache` will return.
+
+    :param directory: Where to store the cache, or ``None`` to disable caching.
+    :param max_size: The most bytes the cache may take up.
+    """
+    global _cache
+    if directory is None:
+        _cache = None
+    else:
+        _cache = DiskCache(directory, max_size)
+
+
+def get_cache():
+    """Return the build's :class:`DiskCache`, or ``None`` if caching is disabled."""
+    return _cache
@@ -1,12 +1,15 @@
 # stdlib
 import codecs
+import hashlib
+import io
 import shutil
-import tempfile
 
 # external
 import yaml
 
 # internal
+from . import cache
+from . import spooling
 from . import utils
 
 
@@ -25,6 +28,17 @@ class UnicodeSafeLoader(yaml.SafeLoader):
     }
 
 
+if getattr(yaml, "__with_libyaml__", False):
+    class UnicodeSafeCLoader(yaml.CSafeLoader):
+        """The same as :class:`UnicodeSafeLoader` but using libyaml, which is much faster."""
+
+        yaml_constructors = UnicodeSafeLoader.yaml_constructors
+
+    FRONTMATTER_LOADER = UnicodeSafeCLoader
+else:
+    FRONTMATTER_LOADER = UnicodeSafeLoader
+
+
 @utils.public
 def detect_encoding(path):
     """Return encoding of file at path.
@@ -110,7 +124,13 @@ DEFAULT_SPOOL_SIZE = 10 * 1024 * 1024  # 1024 * 1024 is one mebibyte
 @utils.public
 def file(name=None, mode="w+b", spool_size=DEFAULT_SPOOL_SIZE, metadata=None, content=None,
          encoding="utf_8"):
-    temp_file = tempfile.SpooledTemporaryFile(max_size=DEFAULT_SPOOL_SIZE, mode=mode)
+    """Create a new in-memory document.
+
+    The document is kept in memory until it grows past ``spool_size`` bytes, or until the build's
+    memory budget (see :mod:`phial.spooling`) runs out, at which point it's moved to a temporary
+    file on disk.
+    """
+    temp_file = spooling.spooled_file(spool_size, mode=mode)
 
     # Wrap the temporary file to allow unicode
     temp_file = unicodify_file_object(temp_file, encoding=encoding)
@@ -125,24 +145,7 @@ def file(name=None, mode="w+b", spool_size=DEFAULT_SPOOL_SIZE, metadata=None, co
     return temp_file
 
 
-@utils.public
-def parse_frontmatter(document):
-    """Parse a document's frontmatter and contents.
-
-    Will parse a document into its frontmatter and content components. The
-    frontmatter will be decoded with a YAML parser.
-
-    :param document: A path or a file-like object to consume. The file-like
-        object must produce ``unicode`` objects when read from rather than
-        ``str`` (see :func:`open_file`).
-
-    :returns: A two-tuple ``(frontmatter, content)`` where ``frontmatter`` will
-        be whatever the YAML decoder gave us and ``content`` is a file-like
-        object containing the content.
-    """
-    if isinstance(document, basestring):
-        document = open_file(document)
-
+def _parse_frontmatter(document):
     FRONT_MATTER_END = u"..."
 
     # Iterate through every line until we hit the end of the front
@@ -164,7 +167,7 @@ def parse_frontmatter(document):
         return (None, document)
 
     front_matter.seek(0)
-    decoded_front_matter = yaml.load(front_matter.read(), UnicodeSafeLoader)
+    decoded_front_matter = yaml.load(front_matter.read(), FRONTMATTER_LOADER)
 
     content_file = file()
 
@@ -172,3 +175,55 @@ def parse_frontmatter(document):
 
     content_file.seek(0)
     return (decoded_front_matter, content_file)
+
+
+# Bump this whenever parsing changes in a way that would make old cache entries wrong
+FRONTMATTER_CACHE_VERSION = 1
+
+
+def _parse_frontmatter_cached(document, frontmatter_cache):
+    text = document.read()
+    key = "frontmatter:{0!s}:{1}".format(FRONTMATTER_CACHE_VERSION,
+                                         hashlib.sha1(text.encode("utf_8")).hexdigest())
+
+    cached = frontmatter_cache.get(key)
+    if cached is None:
+        frontmatter, content = _parse_frontmatter(io.StringIO(text))
+        cached = (frontmatter, None if frontmatter is None else content.read())
+        frontmatter_cache.set(key, cached)
+
+    frontmatter, content = cached
+    if frontmatter is None:
+        document.seek(0)
+        return (None, document)
+
+    return (frontmatter, file(content=content))
+
+
+@utils.public
+def parse_frontmatter(document):
+    """Parse a document's frontmatter and contents.
+
+    Will parse a document into its frontmatter and content components. The
+    frontmatter will be decoded with a YAML parser.
+
+    If the build has a cache (see :mod:`phial.cache`) results are stored in it
+    keyed by the hash of the document's contents, so unchanged documents don't
+    need to be parsed again in later builds.
+
+    :param document: A path or a file-like object to consume. The file-like
+        object must produce ``unicode`` objects when read from rather than
+        ``str`` (see :func:`open_file`).
+
+    :returns: A two-tuple ``(frontmatter, content)`` where ``frontmatter`` will
+        be whatever the YAML decoder gave us and ``content`` is a file-like
+        object containing the content.
+    """
+    if isinstance(document, basestring):
+        document = open_file(document)
+
+    frontmatter_cache = cache.get_cache()
+    if frontmatter_cache is not None:
+        return _parse_frontmatter_cached(document, frontmatter_cache)
+
+    return _parse_frontmatter(document)
@@ -11,7 +11,7 @@ def js(source):
     return source | phial.concat("concat.js")
 
 
-@phial.page("cats/*")
+@phial.page("cats/*", inputs="bio_template.htm")
 def bio_page(source_file):
     template = open("bio_template.htm").read()
     frontmatter, content = phial.parse_frontmatter(source_file)
@@ -23,7 +23,7 @@ def bio_page(source_file):
         content=output)
 
 
-@phial.page(depends_on=bio_page)
+@phial.page(depends_on=bio_page, inputs="main_template.htm")
 def main_page():
     bio_task = phial.get_task(bio_page)
     cat_links = [i.metadata for i in bio_task.files]
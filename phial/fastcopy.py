@@ -0,0 +1,138 @@
+# stdlib
+import ctypes
+import errno
+import fcntl
+import os
+import shutil
+
+# internal
+from . import utils
+
+# set up logging
+import phial.loggers
+log = phial.loggers.get_logger(__name__)
+
+# The ioctl that asks the filesystem to share the source's data with the destination, copying it
+# only when one of them is written to. From linux/fs.h.
+FICLONE = 0x40049409
+
+# How much to ask the kernel to copy in one go
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Errors that mean a method isn't supported for a particular pair of files, rather than that
+# something went wrong.
+UNSUPPORTED_ERRORS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+                          errno.EPERM, errno.EBADF])
+
+METHODS = ["auto", "reflink", "hardlink", "copy"]
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _raise_errno():
+    error = ctypes.get_errno()
+    if error in UNSUPPORTED_ERRORS:
+        raise Unsupported(os.strerror(error))
+    raise OSError(error, os.strerror(error))
+
+
+def _reflink(source_fd, destination_fd):
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except IOError as e:
+        if e.errno in UNSUPPORTED_ERRORS:
+            raise Unsupported(e.strerror)
+        raise
+
+
+def _get_kernel_copy_function():
+    """Return a function that copies between two file descriptors without leaving the kernel.
+
+    copy_file_range() is preferred as it can also make use of reflinks and server-side copies,
+    sendfile() is the fallback for older C libraries.
+    """
+    try:
+        libc = utils.load_libc()
+    except OSError:
+        raise Unsupported("Could not load the C library.")
+
+    copy_file_range = getattr(libc, "copy_file_range", None)
+    if copy_file_range is not None:
+        copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_size_t, ctypes.c_uint]
+        copy_file_range.restype = ctypes.c_ssize_t
+        return ("copy_file_range",
+                lambda source, destination, count: copy_file_range(source, None, destination,
+                                                                   None, count, 0))
+
+    sendfile = getattr(libc, "sendfile", None)
+    if sendfile is not None:
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+        return ("sendfile",
+                lambda source, destination, count: sendfile(destination, source, None, count))
+
+    raise Unsupported("The C library has neither copy_file_range() nor sendfile().")
+
+
+def _kernel_copy(source_fd, destination_fd):
+    name, function = _get_kernel_copy_function()
+
+    copied = 0
+    while True:
+        result = function(source_fd, destination_fd, KERNEL_COPY_CHUNK_SIZE)
+        if result < 0:
+            if copied:
+                # We can't fall back after we've already copied part of the file
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+            _raise_errno()
+        elif result == 0:
+            return name
+
+        copied += result
+
+
+def copy_file(source_path, destination_path, method="auto"):
+    """Make the file at ``destination_path`` have the same contents as ``source_path``.
+
+    The contents are never copied through Python if it can be avoided.
+
+    :param method: ``"reflink"`` shares the data between both files until one of them is
+        modified, which only some filesystems (such as btrfs and XFS) support. ``"hardlink"``
+        makes both paths refer to the same file, so modifying one modifies the other.
+        ``"copy"`` copies the contents through Python. ``"auto"`` tries reflinking, then copying
+        within the kernel, then copying through Python. Whenever a method isn't supported for
+        the given files we fall back to the next best one.
+
+    :returns: The name of the method actually used.
+    """
+    if method == "hardlink":
+        try:
+            os.link(source_path, destination_path)
+            return "hardlink"
+        except OSError as e:
+            log.debug("Could not hard link {0} to {1}, copying instead ({2}).", source_path,
+                      destination_path, e)
+            method = "auto"
+
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        if method in ("auto", "reflink"):
+            try:
+                _reflink(source.fileno(), destination.fileno())
+                return "reflink"
+            except Unsupported:
+                pass
+
+        if method != "copy":
+            try:
+                return _kernel_copy(source.fileno(), destination.fileno())
+            except Unsupported:
+                pass
+
+        shutil.copyfileobj(source, destination, COPY_CHUNK_SIZE)
+        return "copy"
@@ -0,0 +1,385 @@
+# stdlib
+import errno
+import hashlib
+import json
+import os
+
+# internal
+from . import documents
+from . import utils
+
+# set up logging
+import phial.loggers
+log = phial.loggers.get_logger(__name__)
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def hash_file_object(file_object, encoding="utf_8"):
+    """Return a hex digest of everything remaining in ``file_object``.
+
+    Unicode chunks are encoded with ``encoding`` first so the digest matches the bytes that would
+    end up on disk.
+    """
+    hasher = hashlib.sha1()
+    while True:
+        chunk = file_object.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(encoding)
+        hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def hash_path(path):
+    with open(path, "rb") as f:
+        return hash_file_object(f)
+
+
+def stat_path(path):
+    """Return a record of the size and modification time of the file at ``path``."""
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def describe_task_id(task_id):
+    """Return a string identifying a task across builds."""
+    module = getattr(task_id, "__module__", None)
+    name = getattr(task_id, "__name__", None)
+    if module and name:
+        return u"{0}.{1}".format(module, name)
+
+    return repr(task_id)
+
+
+class RestoredDocument(object):
+    """Stands in for a document produced by a task that was skipped.
+
+    The document's contents are read back from the output directory the first time they're
+    needed, so restoring a large task doesn't open thousands of files.
+    """
+
+    def __init__(self, path, name, metadata, binary_mode):
+        self._path = path
+        self._binary_mode = binary_mode
+        self._file = None
+        self.name = name
+        self.metadata = metadata
+
+    def _get_file(self):
+        if self._file is None:
+            if self._binary_mode:
+                self._file = open(self._path, "rb")
+            else:
+                self._file = documents.open_file(self._path)
+
+        return self._file
+
+    def __getattr__(self, name):
+        return getattr(self._get_file(), name)
+
+    def __iter__(self):
+        return iter(self._get_file())
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.name)
+
+
+class BuildIndex(object):
+    """The on-disk record of what previous builds consumed and produced.
+
+    For every task the index stores the paths it read along with their sizes, modification times
+    and hashes, and for every output file it stores the hash of its contents. This lets a rebuild
+    skip tasks whose inputs are unchanged and avoid rewriting output files whose contents are
+    identical. It also lets us remove output files that are no longer produced.
+
+    Task records are only trusted if the application script is unchanged since the build that
+    wrote them. Output records are always trusted because they only describe bytes on disk.
+
+    If ``changed_paths`` is given (by monitor mode, which knows exactly what changed since the
+    last build) only inputs in it, or in a directory in it, are considered changed, which saves
+    checking every input of every task.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, output_dir, app_hash=None, changed_paths=None):
+        self.path = path
+        self.output_dir = output_dir
+        self.app_hash = app_hash
+        self.changed_paths = changed_paths
+
+        self.previous_tasks, self.previous_outputs = self._load()
+
+        # Every input recorded by the previous build, so hashes can be reused
+        self.previous_inputs = {}
+        for i in self.previous_tasks.itervalues():
+            self.previous_inputs.update(i["inputs"])
+
+        self.tasks = {}
+        self.outputs = {}
+
+        # The keys of the tasks that actually ran during this build
+        self.rebuilt = set()
+
+        # Maps each task's id to its key in the index
+        self._keys = {}
+        self._taken_keys = set()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.warning("Could not read index at {0}, doing a full build.", self.path,
+                            exc_info=True)
+            return ({}, {})
+        except ValueError:
+            log.warning("Index at {0} is corrupt, doing a full build.", self.path)
+            return ({}, {})
+
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            log.info("Index at {0} is from a different version of Phial, ignoring it.", self.path)
+            return ({}, {})
+
+        previous_tasks = data.get("tasks", {})
+        if data.get("app_hash") != self.app_hash:
+            log.info("Application changed since the last build, all tasks will run.")
+            previous_tasks = {}
+
+        return (previous_tasks, data.get("outputs", {}))
+
+    def get_key(self, task):
+        """Return the key ``task`` is stored under, assigning a new one if necessary.
+
+        Keys are derived from the task's id. Tasks generated in a loop tend to share a name so
+        repeated keys are made unique by their position in the build, which is stable as long as
+        the application is.
+        """
+        if task.id not in self._keys:
+            base_key = describe_task_id(task.id)
+            key = base_key
+            suffix = 1
+            while key in self._taken_keys:
+                suffix += 1
+                key = u"{0}#{1}".format(base_key, suffix)
+            self._keys[task.id] = key
+            self._taken_keys.add(key)
+
+        return self._keys[task.id]
+
+    def _dependencies_rebuilt(self, task):
+        for i in task.get_dependencies():
+            key = self._keys.get(i)
+            if key is None or key in self.rebuilt:
+                return True
+
+        return False
+
+    def _in_changed_paths(self, path):
+        path = os.path.abspath(path)
+        while True:
+            if path in self.changed_paths:
+                return True
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def _input_changed(self, path, record):
+        if self.changed_paths is not None:
+            return self._in_changed_paths(path)
+
+        try:
+            current = stat_path(path)
+        except OSError:
+            return True
+
+        if current["size"] != record["size"]:
+            return True
+        elif current["mtime"] == record["mtime"]:
+            return False
+
+        # The file was touched, but its contents may be the same
+        return hash_path(path) != record["hash"]
+
+    def _output_missing(self, relative_path):
+        record = self.previous_outputs.get(relative_path)
+        if record is None:
+            return True
+
+        try:
+            return stat_path(os.path.join(self.output_dir, relative_path)) != {
+                "mtime": record["mtime"], "size": record["size"]}
+        except OSError:
+            return True
+
+    def can_skip(self, task, input_paths):
+        """Return True if running ``task`` would produce the same files as last time.
+
+        Tasks without any inputs are never skipped because we can't know what they depend on.
+        """
+        key = self.get_key(task)
+        record = self.previous_tasks.get(key)
+        if record is None or record.get("files") is None or not input_paths:
+            return False
+
+        if not all(isinstance(i, basestring) for i in input_paths):
+            return False
+
+        if sorted(record["inputs"]) != sorted(set(input_paths)):
+            return False
+
+        if self._dependencies_rebuilt(task):
+            return False
+
+        for path, input_record in record["inputs"].iteritems():
+            if self._input_changed(path, input_record):
+                return False
+
+        return not any(self._output_missing(i["output"]) for i in record["files"])
+
+    def restore(self, task):
+        """Carry the previous record of ``task`` into this build and return its files."""
+        key = self.get_key(task)
+        record = self.previous_tasks[key]
+        self.tasks[key] = record
+
+        files = []
+        for i in record["files"]:
+            self.outputs[i["output"]] = self.previous_outputs[i["output"]]
+            files.append(RestoredDocument(os.path.join(self.output_dir, i["output"]), i["name"],
+                                          i["metadata"], record["binary_mode"]))
+
+        return files
+
+    def _get_input_record(self, path):
+        record = stat_path(path)
+
+        # Don't hash the file again if it looks the same as it did last time
+        previous = self.previous_inputs.get(path)
+        if previous is not None and all(previous[i] == record[i] for i in ("size", "mtime")):
+            record["hash"] = previous["hash"]
+        else:
+            record["hash"] = hash_path(path)
+
+        self.previous_inputs[path] = record
+        return record
+
+    def hash_input(self, path):
+        """Return the hash of the input file at ``path``, reusing previous hashes if possible."""
+        return self._get_input_record(path)["hash"]
+
+    def record_task(self, task, input_paths, files):
+        key = self.get_key(task)
+        self.rebuilt.add(key)
+
+        inputs = {}
+        for i in input_paths:
+            if isinstance(i, basestring):
+                inputs[i] = self._get_input_record(i)
+
+        file_records = []
+        for i in files:
+            metadata = getattr(i, "metadata", None)
+            try:
+                json.dumps(metadata)
+            except (TypeError, ValueError):
+                log.debug("Metadata of {0!r} can't be stored in the index, {1!r} will always run.",
+                          i.name, key)
+                file_records = None
+                break
+
+            file_records.append({
+                "name": i.name,
+                "output": self.get_output_key(os.path.join(self.output_dir, i.name)),
+                "metadata": metadata,
+            })
+
+        self.tasks[key] = {
+            "binary_mode": task.binary_mode,
+            "inputs": inputs,
+            "files": file_records,
+        }
+
+    def export_task(self, task, output_keys):
+        """Return everything this index learned about ``task`` and the given outputs.
+
+        The result can be given to :meth:`import_task` on the index in another process.
+        """
+        key = self.get_key(task)
+        outputs = {}
+        for i in output_keys:
+            outputs[i] = self.outputs[i]
+
+        return {
+            "key": key,
+            "record": self.tasks.get(key),
+            "outputs": outputs,
+            "rebuilt": key in self.rebuilt,
+        }
+
+    def import_task(self, task, exported):
+        key = self.get_key(task)
+        assert key == exported["key"], "Task keys must be assigned before forking."
+
+        if exported["record"] is not None:
+            self.tasks[key] = exported["record"]
+        self.outputs.update(exported["outputs"])
+        if exported["rebuilt"]:
+            self.rebuilt.add(key)
+
+    def get_output_key(self, output_path):
+        return os.path.relpath(output_path, self.output_dir)
+
+    def is_output_current(self, output_path, digest):
+        """Return True if the file at ``output_path`` already contains data hashing to ``digest``.
+        """
+        key = self.get_output_key(output_path)
+        record = self.previous_outputs.get(key)
+        if record is None or record["hash"] != digest:
+            return False
+
+        return not self._output_missing(key)
+
+    def record_output(self, output_path, digest):
+        record = stat_path(output_path)
+        record["hash"] = digest
+        self.outputs[self.get_output_key(output_path)] = record
+
+    def remove_stale_outputs(self):
+        """Delete output files that a previous build created but this one did not."""
+        for i in set(self.previous_outputs) - set(self.outputs):
+            path = os.path.join(self.output_dir, i)
+            if not utils.is_path_under_directory(path, self.output_dir):
+                continue
+
+            log.info("Removing stale output file {0}.", path)
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def save(self):
+        """Write the index to disk, atomically replacing the old one."""
+        data = {
+            "version": self.VERSION,
+            "app_hash": self.app_hash,
+            "tasks": self.tasks,
+            "outputs": self.outputs,
+        }
+
+        utils.makedirs(os.path.dirname(self.path))
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            json.dump(data, f)
+        os.rename(temp_path, self.path)
+
+        log.debug("Wrote index with {0!s} tasks and {1!s} outputs to {2}.", len(self.tasks),
+                  len(self.outputs), self.path)
@@ -9,7 +9,8 @@ log = phial.loggers.get_logger(__name__)
 
 
 @utils.public
-def page(foreach=[], task_queue=tasks.global_queue, depends_on=None):
+def page(foreach=[], task_queue=tasks.global_queue, depends_on=None, inputs=None, workers=None,
+         stream=False):
     # We allow users to write @page without the (). This permits that.
     foreach_is_func = hasattr(foreach, "__call__")
 
@@ -18,11 +19,11 @@ def page(foreach=[], task_queue=tasks.global_queue, depends_on=None):
         # function will be given as a pipeline, which in turn will call the user's page function
         # appropriately.
         def page_to_pipeline_adapter(source):
-            if len(source.contents) == 0:
+            if not apparent_foreach:
                 source.contents = [function()]
                 return source
             else:
-                return source | pipelines.map(function)
+                return source | pipelines.map(function, workers=workers)
 
         # If the user decorated this page with @page instead of @page(...), foreach will be the
         # same as function. In which case we should treat foreach as empty.
@@ -31,7 +32,7 @@ def page(foreach=[], task_queue=tasks.global_queue, depends_on=None):
             apparent_foreach = []
 
         task = pipelines.PipelineTask(page_to_pipeline_adapter, apparent_foreach, False, function,
-                                      depends_on)
+                                      depends_on, inputs, stream)
         task_queue.enqueue(task)
         return function
 
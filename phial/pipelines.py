@@ -1,13 +1,28 @@
 # stdlib
+import codecs
+import cPickle as pickle
+import errno
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
 import shutil
 import sys
 import os.path
 import subprocess
+import threading
+import time
+import types
 
 # internal
 from . import utils
 from . import tasks
+from . import cache
 from . import documents
+from . import fastcopy
+from . import profiler
+from . import spooling
+import phial.index
 
 # set up logging
 import phial.loggers
@@ -15,71 +30,249 @@ log = phial.loggers.get_logger(__name__)
 
 
 @utils.public
-def pipeline(foreach=[], binary_mode=True, task_queue=tasks.global_queue, depends_on=None):
+def pipeline(foreach=[], binary_mode=True, task_queue=tasks.global_queue, depends_on=None,
+             inputs=None, stream=False):
     def real_decorator(function):
-        task_queue.enqueue(PipelineTask(function, foreach, binary_mode, function, depends_on))
+        task_queue.enqueue(PipelineTask(function, foreach, binary_mode, function, depends_on,
+                                        inputs, stream))
         return function
 
     return real_decorator
 
 
 class PipelineTask(tasks.Task):
-    def __init__(self, function, foreach, binary_mode, id, depends_on=None):
+    """A task that runs a pipeline function and writes the files it yields.
+
+    ``inputs`` lists any files (or globs) the function reads other than the ones in ``foreach``,
+    such as templates. They are not opened for the function, but the index will consider them
+    when deciding whether the task needs to run again.
+
+    If ``stream`` is True the function's source holds a generator rather than a list, so each
+    input is only opened once something asks for it. If the function's result is also a generator
+    (as it will be if it only uses transforms like ``map``) every document is written and closed
+    as soon as it's produced, so only a handful of files are ever open at once no matter how many
+    inputs there are.
+    """
+
+    def __init__(self, function, foreach, binary_mode, id, depends_on=None, inputs=None,
+                 stream=False):
         self.function = function
         self.foreach = foreach
         self.binary_mode = binary_mode
+        self.inputs = inputs or []
+        self.stream = stream
         self.files = None
         super(PipelineTask, self).__init__(id=id, depends_on=depends_on)
 
     def run(self, config):
+        with profiler.measure(phial.index.describe_task_id(self.id), "task") as span:
+            self._run(config, span)
+
+    def _run(self, config, span):
         if self.binary_mode:
             def open_file(path):
                 return open(path, "rb")
         else:
             open_file = documents.open_file
 
+        index = config.get("index")
+
         # Glob and open all of the files the user specified
         globbed_foreach = utils.glob_foreach_list(self.foreach)
-        files = [open_file(path) for path in globbed_foreach]
+        input_paths = globbed_foreach + utils.glob_foreach_list(self.inputs)
+        span.add("files_in", len(globbed_foreach))
+        if span.enabled:
+            span.add("bytes_in", sum(os.path.getsize(i) for i in input_paths
+                                     if isinstance(i, basestring)))
+
+        if index is not None and index.can_skip(self, input_paths):
+            log.info("Inputs of {0!r} are unchanged, skipping it.", self.function)
+            span.add("skipped")
+            self.files = index.restore(self)
+            return
+
+        if self.stream:
+            files = (open_file(path) for path in globbed_foreach)
+        else:
+            files = [open_file(path) for path in globbed_foreach]
 
         result = self.function(PipelineSource(files))
-        log.info("Pipe function {0!r} yielded {1!s} files.", self.function, len(result.contents))
-
-        self.files = list(result.contents)
-        for i in self.files:
-            output_path = os.path.join(config["output"], i.name)
-            if not utils.is_path_under_directory(output_path, config["output"]):
-                log.fatal(
-                    "Target path must be relative and under the output directory. Did you begin "
-                    "the path with a / or .. ?")
-
-            # Ensure that the target directory exists
-            utils.makedirs(os.path.dirname(output_path))
 
+        if isinstance(result.contents, list):
+            self.files = list(result.contents)
+            for i in self.files:
+                self._write_document(i, config, span)
+        else:
+            # Nothing is kept in memory, anybody who wants a document later will read it back
+            # from the output directory.
+            self.files = []
+            for i in result.contents:
+                output_path = self._write_document(i, config, span)
+                i.close()
+                self.files.append(phial.index.RestoredDocument(
+                    output_path, i.name, getattr(i, "metadata", None), self.binary_mode))
+
+        log.info("Pipe function {0!r} yielded {1!s} files.", self.function, len(self.files))
+
+        if index is not None:
+            index.record_task(self, input_paths, self.files)
+
+    def _write_document(self, document, config, span):
+        output_path = os.path.join(config["output"], document.name)
+        if not utils.is_path_under_directory(output_path, config["output"]):
+            log.fatal(
+                "Target path must be relative and under the output directory. Did you begin "
+                "the path with a / or .. ?")
+
+        if self.write_output(document, output_path, config.get("index"),
+                             config.get("copy_method", "auto")):
+            span.add("files_written")
+            if span.enabled:
+                span.add("bytes_written", os.path.getsize(output_path))
+        else:
+            span.add("files_unchanged")
+
+        return output_path
+
+    def export_result(self, config):
+        result = {
+            "files": [(i.name, getattr(i, "metadata", None)) for i in self.files],
+            "index": None,
+        }
+
+        index = config.get("index")
+        if index is not None:
+            output_keys = [index.get_output_key(os.path.join(config["output"], i.name))
+                           for i in self.files]
+            result["index"] = index.export_task(self, output_keys)
+
+        return result
+
+    def import_result(self, result, config):
+        # The documents themselves were written to the output directory, so we read them back
+        # from there if anybody asks.
+        self.files = [
+            phial.index.RestoredDocument(os.path.join(config["output"], name), name, metadata,
+                                         self.binary_mode)
+            for name, metadata in result["files"]
+        ]
+
+        if config.get("index") is not None:
+            config["index"].import_task(self, result["index"])
+
+    def write_output(self, document, output_path, index=None, copy_method="auto"):
+        """Write ``document`` to ``output_path``, returning False if it was already there."""
+        source_path = get_passthrough_path(document)
+
+        digest = None
+        if index is not None:
+            if source_path is not None:
+                digest = index.hash_input(source_path)
+            else:
+                digest = phial.index.hash_file_object(document)
+                document.seek(0)
+
+            if index.is_output_current(output_path, digest):
+                log.debug("Output file {0} is unchanged, not rewriting it.", output_path)
+                index.record_output(output_path, digest)
+                return False
+
+        # Ensure that the target directory exists
+        utils.makedirs(os.path.dirname(output_path))
+
+        # The old output may be a hard link to an input, which we'd clobber if we wrote into it
+        try:
+            os.remove(output_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        if source_path is not None:
+            method = fastcopy.copy_file(source_path, output_path, copy_method)
+            log.debug("Copied {0} to {1} using {2}.", source_path, output_path, method)
+        else:
             if self.binary_mode:
                 output_file = open(output_path, "wb")
             else:
                 output_file = documents.unicodify_file_object(open(output_path, "w"))
 
-            shutil.copyfileobj(i, output_file)
+            with output_file:
+                shutil.copyfileobj(document, output_file)
+
+        if index is not None:
+            index.record_output(output_path, digest)
+
+        return True
+
+
+def get_passthrough_path(document):
+    """Return the path of the input file ``document`` is, if it was passed through untouched.
+
+    Binary pipelines get their inputs as read-only file objects. If one of those makes it to the
+    end of the pipeline its contents are exactly those of the file on disk, so the output can be
+    created without reading it into Python at all.
+    """
+    if isinstance(document, types.FileType) and document.mode == "rb":
+        if isinstance(document.name, basestring) and os.path.isfile(document.name):
+            return document.name
+
+    return None
+
+
+def describe_transform(transform):
+    """Return a short name for a transform, for use in profiles."""
+    if hasattr(transform, "__name__"):
+        return transform.__name__
+    elif type(transform).__repr__ is not object.__repr__:
+        return repr(transform)
+
+    return transform.__class__.__name__
+
+
+def _prepare_document(document):
+    assert hasattr(document, "name"), "{0!r} does not have name attribute.".format(document)
+    document.seek(0)
+
+
+def _prepare_lazily(contents):
+    for i in contents:
+        if i is not None:
+            _prepare_document(i)
+            yield i
 
 
 class PipelineSource(object):
+    """The documents flowing through a pipeline.
+
+    ``contents`` is usually a list, but it may be any other iterable (such as a generator), in
+    which case the source streams: nothing is read until the end of the pipeline asks for it, and
+    each transform should consume and produce documents one at a time, as ``map`` does.
+    """
+
     def prepare_contents(self):
         # We always prune out None values as if they were never there
-        self.contents = [i for i in self.contents if i is not None]
-
-        for i in self.contents:
-            assert hasattr(i, "name"), "{0!r} does not have name attribute.".format(i)
-            i.seek(0)
+        if isinstance(self.contents, list):
+            self.contents = [i for i in self.contents if i is not None]
+            for i in self.contents:
+                _prepare_document(i)
+        else:
+            self.contents = _prepare_lazily(self.contents)
 
     def __init__(self, contents):
         self.contents = contents
         self.prepare_contents()
 
     def pipe(self, transform):
-        self.contents = transform(self.contents)
-        self.prepare_contents()
+        with profiler.measure(describe_transform(transform), "stage") as span:
+            # A streaming stage does its work whenever its documents are asked for, so there's
+            # nothing worth counting here.
+            if isinstance(self.contents, list):
+                span.add("documents_in", len(self.contents))
+            self.contents = transform(self.contents)
+            self.prepare_contents()
+            if isinstance(self.contents, list):
+                span.add("documents_out", len(self.contents))
+
         return self
 
     def __or__(self, transform):
@@ -90,21 +283,174 @@ class PipelineSource(object):
 
 
 class run(object):
+    """Pipe every document through a command, producing a single document with its output.
+
+    Documents are streamed to the command's stdin (text is encoded as UTF-8) from a separate
+    thread while its stdout is read back, a chunk at a time, so neither the input nor the output
+    needs to fit in memory all at once.
+    """
+
+    # How much to read from a document or the command's stdout at once
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, output_name, args, popen_kwargs=None):
         self.args = args
         self.output_name = output_name
         self.popen_kwargs = popen_kwargs or {}
 
+    def _feed(self, stdin, contents, errors):
+        try:
+            for i in contents:
+                while True:
+                    chunk = i.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if isinstance(chunk, unicode):
+                        chunk = chunk.encode("utf_8")
+                    stdin.write(chunk)
+        except IOError as e:
+            # The command exited without reading everything, which is its business
+            if e.errno != errno.EPIPE:
+                errors.append(sys.exc_info())
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            try:
+                stdin.close()
+            except IOError:
+                pass
+
     def __call__(self, contents):
         p = subprocess.Popen(self.args, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
                              **self.popen_kwargs)
-        stdout = p.communicate("".join(i.read() for i in contents))[0]
+
+        errors = []
+        feeder = threading.Thread(target=self._feed, args=(p.stdin, contents, errors))
+        feeder.daemon = True
+        feeder.start()
 
         result = documents.file(name=self.output_name)
-        result.write(stdout)
+        decoder = codecs.getincrementaldecoder("utf_8")()
+        while True:
+            chunk = p.stdout.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            result.write(decoder.decode(chunk))
+        result.write(decoder.decode("", True))
+
+        p.stdout.close()
+        feeder.join()
+        p.wait()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
         return [result]
 
 
+def _kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        # It already exited
+        pass
+
+
+@utils.public
+class run_each(object):
+    """Pipe each document through its own run of a command.
+
+    Every document is given to the command on stdin and replaced with whatever it writes to
+    stdout, keeping the document's name and metadata. Text is encoded as UTF-8 on the way in and
+    decoded as UTF-8 on the way out.
+
+    Up to ``workers`` commands (by default, one per CPU) run at once, but the documents come out
+    in the same order they went in. A command that takes longer than ``timeout`` seconds is
+    killed. A command that's killed or exits with a non-zero status is tried again up to
+    ``retries`` more times before the build fails. How long each run took is recorded by the
+    profiler.
+    """
+
+    def __init__(self, args, workers=None, timeout=None, retries=0, popen_kwargs=None):
+        self.args = args
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.popen_kwargs = popen_kwargs or {}
+
+    def __repr__(self):
+        return "run_each({0})".format(os.path.basename(self.args[0]))
+
+    def _run_once(self, content):
+        """Return ``(returncode, stdout, timed_out)`` for a single run of the command."""
+        p = subprocess.Popen(self.args, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                             **self.popen_kwargs)
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, _kill_process, (p, ))
+            timer.start()
+
+        try:
+            stdout = p.communicate(content)[0]
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        # A timer that's already fired can't be cancelled
+        timed_out = timer is not None and timer.finished.is_set() and p.returncode < 0
+        return (p.returncode, stdout, timed_out)
+
+    def apply(self, document):
+        """Run the command on a single document, returning ``(document, start, wall, runs)``."""
+        content = document.read()
+        is_text = isinstance(content, unicode)
+        if is_text:
+            content = content.encode("utf_8")
+
+        start = time.time()
+        for attempt in xrange(self.retries + 1):
+            returncode, stdout, timed_out = self._run_once(content)
+            if returncode == 0:
+                break
+
+            if timed_out:
+                log.warning("{0!r} timed out after {1!s} seconds on {2}.", self, self.timeout,
+                            document.name)
+            else:
+                log.warning("{0!r} exited with status {1!s} on {2}.", self, returncode,
+                            document.name)
+        else:
+            log.fatal("{0!r} failed on {1} after {2!s} attempt(s).", self, document.name,
+                      self.retries + 1)
+        wall = time.time() - start
+
+        if is_text:
+            stdout = stdout.decode("utf_8")
+        result = _deserialize_document(
+            (document.name, getattr(document, "metadata", None), stdout))
+
+        return (result, start, wall, attempt + 1)
+
+    def __call__(self, contents):
+        contents = list(contents)
+
+        # The commands do the actual work so threads are all we need to keep them busy
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        try:
+            results = []
+            for document, start, wall, runs in pool.imap(self.apply, contents):
+                log.debug("{0!r} took {1!s} ms on {2}.", self, int(wall * 1000), document.name)
+                profiler.record(repr(self), "command", start, wall, {"runs": runs})
+                results.append(document)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return results
+
+
 @utils.public
 class concat(object):
     def __init__(self, output_name=None):
@@ -122,7 +468,15 @@ class cout(object):
     def __init__(self, out=sys.stdout):
         self.out = sys.stdout
 
+    def _copy_lazily(self, contents):
+        for i in contents:
+            shutil.copyfileobj(i, self.out)
+            yield i
+
     def __call__(self, contents):
+        if not isinstance(contents, list):
+            return self._copy_lazily(contents)
+
         for i in contents:
             shutil.copyfileobj(i, self.out)
         return contents
@@ -139,14 +493,192 @@ class move(object):
         return contents
 
 
+# The function and documents being mapped over by the current parallel map. Worker processes are
+# forked after this is set, so they can find both without us having to pickle them.
+_parallel_map_state = None
+
+
+def _serialize_document(document):
+    if document is None:
+        return None
+
+    document.seek(0)
+    return (document.name, getattr(document, "metadata", None), document.read())
+
+
+def _deserialize_document(serialized):
+    if serialized is None:
+        return None
+
+    name, metadata, content = serialized
+    if isinstance(content, unicode):
+        return documents.file(name=name, metadata=metadata, content=content)
+
+    # Binary documents can't go through documents.file() because it expects unicode
+    document = spooling.spooled_file(documents.DEFAULT_SPOOL_SIZE)
+    document.write(content)
+    document.seek(0)
+    document.name = name
+    document.metadata = metadata
+    return document
+
+
+def _init_parallel_map_worker():
+    # Events inherited from the parent process are already recorded there
+    if profiler.get_profiler() is not None:
+        profiler.get_profiler().take_events()
+
+
+def _parallel_map_worker(index):
+    mapper, contents = _parallel_map_state
+    try:
+        result = _serialize_document(mapper.apply(contents[index], index))
+    except Exception:
+        # The exception is re-raised in the parent process, but its traceback is lost on the way
+        log.warning("Failed to map {0!r} over document {1!s}.", mapper.func, index, exc_info=True)
+        raise
+
+    events = None
+    if profiler.get_profiler() is not None:
+        events = profiler.get_profiler().take_events()
+
+    return (result, events)
+
+
 @utils.public
 class map(object):
-    def __init__(self, func, counter=False):
+    """Transform every document with ``func``.
+
+    If ``workers`` is greater than 1, documents are transformed across that many forked worker
+    processes and the results are collected in their original order. ``func`` must return
+    documents whose name, metadata, and contents can be pickled.
+
+    Given anything other than a list (such as a streaming :class:`PipelineSource`'s generator),
+    documents are transformed one at a time as they're asked for and a generator is returned. A
+    stream can't be spread across workers without reading all of it first, so ``workers`` is
+    ignored in that case.
+    """
+
+    # The most documents that will be sent to a worker at once
+    MAX_CHUNK_SIZE = 64
+
+    def __init__(self, func, counter=False, workers=None):
         self.func = func
         self.counter = counter
+        self.workers = workers
+
+    def __repr__(self):
+        return "map({0})".format(getattr(self.func, "__name__", repr(self.func)))
+
+    def apply(self, item, index):
+        """Transform a single document."""
+        with profiler.measure(getattr(item, "name", None) or str(index), "file"):
+            if self.counter:
+                return self.func(item, index)
+            else:
+                return self.func(item)
+
+    def _map_in_parallel(self, contents):
+        global _parallel_map_state
+        _parallel_map_state = (self, contents)
+
+        chunk_size = max(1, min(self.MAX_CHUNK_SIZE, len(contents) // (self.workers * 4)))
+        pool = multiprocessing.Pool(self.workers, _init_parallel_map_worker)
+        try:
+            results = []
+            for serialized, events in pool.imap(_parallel_map_worker, xrange(len(contents)),
+                                                chunk_size):
+                results.append(_deserialize_document(serialized))
+                if events:
+                    profiler.get_profiler().add_events(events)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _parallel_map_state = None
+
+        return results
 
     def __call__(self, contents):
-        if self.counter:
-            return [self.func(item, index) for index, item in enumerate(contents)]
+        if not isinstance(contents, list):
+            return (self.apply(item, index) for index, item in enumerate(contents))
+        elif self.workers > 1 and len(contents) > 1:
+            return self._map_in_parallel(contents)
+        else:
+            return [self.apply(item, index) for index, item in enumerate(contents)]
+
+
+# Bump this whenever the way cached transforms are stored changes
+CACHED_TRANSFORM_VERSION = 1
+
+
+def _hash_documents(documents_in):
+    digest = hashlib.sha1()
+    for i in documents_in:
+        metadata = json.dumps(getattr(i, "metadata", None), sort_keys=True, default=repr)
+        digest.update(json.dumps([i.name, metadata]))
+
+        i.seek(0)
+        content = i.read()
+        i.seek(0)
+        if isinstance(content, unicode):
+            digest.update("text:" + content.encode("utf_8"))
         else:
-            return [self.func(item) for item in contents]
+            digest.update("binary:" + content)
+
+    return digest.hexdigest()
+
+
+class CachedTransform(object):
+    """Wraps a transform so its results are kept in the build's cache, see :func:`cached`."""
+
+    def __init__(self, transform, version=""):
+        self.transform = transform
+        self.version = version
+
+    def __repr__(self):
+        return "cached({0})".format(describe_transform(self.transform))
+
+    def __call__(self, contents):
+        transform_cache = cache.get_cache()
+        if transform_cache is None:
+            return self.transform(contents)
+
+        contents = list(contents)
+        key = "transform:{0!s}:{1}:{2}:{3}".format(
+            CACHED_TRANSFORM_VERSION, describe_transform(self.transform), self.version,
+            _hash_documents(contents))
+
+        cached_result = transform_cache.get(key)
+        if cached_result is not None:
+            profiler.count("cache_hits")
+            return [_deserialize_document(i) for i in cached_result]
+
+        profiler.count("cache_misses")
+        result = list(self.transform(contents))
+        try:
+            transform_cache.set(key, [_serialize_document(i) for i in result])
+        except (pickle.PicklingError, TypeError):
+            log.debug("Result of {0!r} can't be cached.", self.transform, exc_info=True,
+                      exc_ignored=True)
+
+        return result
+
+
+@utils.public
+def cached(transform=None, version=""):
+    """Keep the results of a transform in the build's cache (see :mod:`phial.cache`).
+
+    The results are keyed by the names, metadata, and contents of the documents given to the
+    transform, so when none of those change the transform isn't run at all. Change ``version``
+    whenever the transform would give different results for the same documents (such as when
+    its arguments change). The documents it produces must be picklable, and it will be given a
+    list even in a streaming pipeline.
+
+    Can wrap a transform directly (``source | cached(concat("all.css"), version="1")``) or be
+    used as a decorator (``@cached(version="1")``). Without a cache this does nothing.
+    """
+    if transform is None:
+        return lambda transform: CachedTransform(transform, version)
+
+    return CachedTransform(transform, version)
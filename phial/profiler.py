@@ -0,0 +1,203 @@
+# stdlib
+import contextlib
+import json
+import os
+import time
+
+
+def _get_cpu_time():
+    """Return the user and system CPU time used by this process so far, in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Span(object):
+    """Counters for one measured piece of work, see :meth:`Profiler.measure`."""
+
+    enabled = True
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.counters = {}
+
+    def add(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+
+class NullSpan(object):
+    """Stands in for a :class:`Span` when profiling is disabled."""
+
+    enabled = False
+
+    def add(self, counter, amount=1):
+        pass
+
+
+class Profiler(object):
+    """Records how long each part of a build takes.
+
+    Work is measured in spans (see :meth:`measure`), each belonging to a category: ``"task"``
+    for a whole task, ``"stage"`` for a single transform in a pipeline, ``"command"`` for a
+    single run of an external command, and ``"file"`` for a single document in a map (only if
+    ``per_file`` is True, as there can be a great many of them). Every span records its wall and
+    CPU time along with any counters it was given, such as the number of files or bytes written.
+    """
+
+    def __init__(self, per_file=False):
+        self.per_file = per_file
+        self.events = []
+        self._stack = []
+
+    @contextlib.contextmanager
+    def measure(self, name, category):
+        span = Span(name, category)
+        parent = self._stack[-1].name if self._stack else None
+
+        self._stack.append(span)
+        start_wall = time.time()
+        start_cpu = _get_cpu_time()
+        try:
+            yield span
+        finally:
+            self._stack.pop()
+            self.events.append({
+                "name": span.name,
+                "category": category,
+                "parent": parent,
+                "pid": os.getpid(),
+                "start": start_wall,
+                "wall": time.time() - start_wall,
+                "cpu": _get_cpu_time() - start_cpu,
+                "counters": span.counters,
+            })
+
+    def record(self, name, category, start, wall, counters=None):
+        """Record work that was timed elsewhere, such as in another thread.
+
+        The work's CPU time isn't known so it's recorded as 0.
+        """
+        self.events.append({
+            "name": name,
+            "category": category,
+            "parent": self._stack[-1].name if self._stack else None,
+            "pid": os.getpid(),
+            "start": start,
+            "wall": wall,
+            "cpu": 0.0,
+            "counters": counters or {},
+        })
+
+    def take_events(self):
+        """Remove and return every event recorded so far, see :meth:`add_events`."""
+        events = self.events
+        self.events = []
+        return events
+
+    def add_events(self, events):
+        """Add events recorded by a profiler in another process."""
+        self.events.extend(events)
+
+    def get_summary(self, categories=("task", "stage", "command")):
+        """Return the events in ``categories``, combining ones with the same name.
+
+        The result is sorted so the most time consuming work comes first.
+        """
+        combined = {}
+        for i in self.events:
+            if i["category"] not in categories:
+                continue
+
+            key = (i["category"], i["name"])
+            if key not in combined:
+                combined[key] = {"category": i["category"], "name": i["name"], "count": 0,
+                                 "wall": 0.0, "cpu": 0.0, "counters": {}}
+
+            summary = combined[key]
+            summary["count"] += 1
+            summary["wall"] += i["wall"]
+            summary["cpu"] += i["cpu"]
+            for counter, amount in i["counters"].iteritems():
+                summary["counters"][counter] = summary["counters"].get(counter, 0) + amount
+
+        return sorted(combined.itervalues(), key=lambda summary: -summary["wall"])
+
+    def format_summary(self):
+        lines = ["{0:<6} {1:<40} {2:>9} {3:>9}  {4}".format("kind", "name", "wall (s)", "cpu (s)",
+                                                            "counters")]
+        for i in self.get_summary():
+            counters = ", ".join("{0}={1!s}".format(*j) for j in sorted(i["counters"].items()))
+            lines.append("{0:<6} {1:<40} {2:>9.3f} {3:>9.3f}  {4}".format(
+                i["category"], i["name"][:40], i["wall"], i["cpu"], counters))
+
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.get_summary(("task", "stage", "command", "file")),
+                       "events": self.events}, f, indent=1, sort_keys=True)
+
+    def write_trace(self, path):
+        """Write the events in Chrome's trace event format (viewable at chrome://tracing)."""
+        trace_events = []
+        for i in self.events:
+            trace_events.append({
+                "name": i["name"],
+                "cat": i["category"],
+                "ph": "X",
+                "ts": int(i["start"] * 1000000),
+                "dur": int(i["wall"] * 1000000),
+                "pid": i["pid"],
+                "tid": i["pid"],
+                "args": dict(i["counters"], cpu=i["cpu"]),
+            })
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+# The profiler for this build, see enable()
+_profiler = None
+
+
+def enable(per_file=False):
+    global _profiler
+    _profiler = Profiler(per_file)
+    return _profiler
+
+
+def get_profiler():
+    """Return the build's :class:`Profiler`, or ``None`` if profiling is disabled."""
+    return _profiler
+
+
+@contextlib.contextmanager
+def _measure_nothing():
+    yield NullSpan()
+
+
+def measure(name, category):
+    """Measure the work done in a ``with`` block, if profiling is enabled.
+
+    The ``with`` statement gives a span (see :class:`Span`) that counters can be added to, which
+    is a :class:`NullSpan` if profiling is disabled.
+    """
+    if _profiler is None or (category == "file" and not _profiler.per_file):
+        return _measure_nothing()
+
+    return _profiler.measure(name, category)
+
+
+def record(name, category, start, wall, counters=None):
+    """Record work timed elsewhere if profiling is enabled, see :meth:`Profiler.record`."""
+    if _profiler is not None:
+        _profiler.record(name, category, start, wall, counters)
+
+
+def count(counter, amount=1):
+    """Add to a counter of the innermost span being measured, if profiling is enabled.
+
+    This is for code that has no span of its own to add to, see :meth:`Span.add` otherwise.
+    """
+    if _profiler is not None and _profiler._stack:
+        _profiler._stack[-1].add(counter, amount)
@@ -0,0 +1,99 @@
+# stdlib
+import time
+
+# internal
+from . import loggers
+
+log = loggers.get_logger(__name__)
+
+
+def merge_changes(changes, more_changes):
+    """Combine two sets of changed paths, either of which may be ``None`` for "unknown"."""
+    if changes is None or more_changes is None:
+        return None
+    return changes | more_changes
+
+
+class Rebuilder(object):
+    """Decides when to rebuild in monitor mode.
+
+    Bursts of changes (such as checking out a branch) are coalesced: a build only starts once
+    nothing has changed for ``quiet_period`` seconds. If anything changes while a build is running
+    that build is cancelled, and a new one is started once things are quiet again, so the last
+    build always sees the latest state.
+
+    :param watcher: Where changes come from, see :mod:`phial.watchers`.
+    :param start_build: Called with the set of paths that changed (or ``None`` if that isn't
+        known) to start a build in the background. It should return a handle with
+        ``wait(timeout)`` and ``cancel()`` methods, like :class:`phial.tool.BuildProcess`.
+    :param unbuilt_changes: Changes that no successful build has seen yet, which are given to the
+        next build along with whatever else changed.
+    """
+
+    def __init__(self, watcher, start_build, quiet_period, unbuilt_changes=frozenset()):
+        self.watcher = watcher
+        self.start_build = start_build
+        self.quiet_period = quiet_period
+        self.unbuilt_changes = unbuilt_changes
+
+        # Changes that haven't been given to a build yet, and when the latest of them was seen
+        self.pending_changes = set()
+        self.last_change_time = None
+
+        # The running build and the changes it was given
+        self.build = None
+        self.build_changes = None
+
+    def _on_change(self, changed):
+        if changed is None:
+            log.info("Detected change in source files.")
+        else:
+            log.info("Detected change in {0!s} source files.", len(changed))
+            log.debug("Changed paths: {0!r}", sorted(changed))
+
+        self.pending_changes = merge_changes(self.pending_changes, changed)
+        self.last_change_time = time.time()
+
+        if self.build is not None:
+            log.info("Cancelling the current build, it's already out of date.")
+            self.cancel()
+
+    def _check_build(self):
+        succeeded = self.build.wait(0)
+        if succeeded is not None:
+            self.unbuilt_changes = set() if succeeded else self.build_changes
+            self.build = None
+
+    def _start_build(self):
+        log.info("Rebuilding...")
+        self.build_changes = merge_changes(self.unbuilt_changes, self.pending_changes)
+        self.build = self.start_build(self.build_changes)
+        self.pending_changes = set()
+        self.last_change_time = None
+
+    def step(self):
+        """Wait for something to happen and deal with it."""
+        if self.build is None and self.last_change_time is None:
+            # Nothing to do until something changes
+            changed = self.watcher.wait()
+        else:
+            changed = self.watcher.wait(self.quiet_period)
+
+        if changed is None or changed:
+            self._on_change(changed)
+        elif self.build is not None:
+            self._check_build()
+        elif time.time() - self.last_change_time >= self.quiet_period:
+            self._start_build()
+
+    def run(self):
+        """Rebuild forever."""
+        while True:
+            self.step()
+
+    def cancel(self):
+        """Cancel the running build, if there is one."""
+        if self.build is not None:
+            self.build.cancel()
+            self.unbuilt_changes = self.build_changes
+            self.build = None
@@ -0,0 +1,132 @@
+# stdlib
+import cPickle as pickle
+import multiprocessing
+import Queue
+
+# internal
+from . import loggers
+from . import profiler
+
+log = loggers.get_logger(__name__)
+
+
+def run_tasks(task_queue, config, jobs=1):
+    """Run every task in ``task_queue``, using up to ``jobs`` processes at once."""
+    if jobs <= 1:
+        for i in task_queue:
+            i.run(config)
+    else:
+        ParallelScheduler(task_queue, config, jobs).run()
+
+
+def _take_profiler_events():
+    if profiler.get_profiler() is None:
+        return []
+    return profiler.get_profiler().take_events()
+
+
+def _run_task_in_child(task, config, results, position):
+    # Events inherited from the parent process are already recorded there
+    _take_profiler_events()
+
+    # Assume failure so that something is always reported, even if the task calls sys.exit()
+    payload = pickle.dumps((position, False, None, []), pickle.HIGHEST_PROTOCOL)
+    try:
+        task.run(config)
+
+        # Pickle here rather than letting the queue do it, otherwise an unpicklable result would
+        # be lost silently in the queue's feeder thread.
+        payload = pickle.dumps(
+            (position, True, task.export_result(config), _take_profiler_events()),
+            pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        show_tb = not isinstance(e, loggers.FatalError)
+        log.warning("Task {0!r} failed.", task.id, exc_info=show_tb)
+    finally:
+        results.put(payload)
+
+
+class ParallelScheduler(object):
+    """Runs the tasks in a queue across several processes.
+
+    Every task is run in its own forked process as soon as all of the tasks it depends on have
+    finished, with at most ``jobs`` tasks running at once. Forking at that point means the task
+    sees everything that finished before it, just as it would when running serially. Once a task
+    finishes its :meth:`Task.export_result` is sent back to this process and given to
+    :meth:`Task.import_result` so tasks started afterwards can see it too.
+    """
+
+    # How long to wait for a result before checking for crashed processes. Measured in seconds.
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, task_queue, config, jobs):
+        self.task_queue = task_queue
+        self.config = config
+        self.jobs = jobs
+
+    def _is_ready(self, task, done):
+        return all(self.task_queue.get_task(i) in done for i in task.get_dependencies())
+
+    def _start(self, ordered, position, results):
+        process = multiprocessing.Process(target=_run_task_in_child,
+                                          args=(ordered[position], self.config, results, position))
+        # Not a daemon because the task may want processes of its own (see pipelines.map)
+        process.daemon = False
+        process.start()
+        log.debug("Started task {0!r} in process {1!s}.", ordered[position].id, process.pid)
+        return process
+
+    def _wait_for_result(self, running, results):
+        """Return ``(position, succeeded, result)`` for the next task to finish."""
+        while True:
+            try:
+                position, succeeded, result, events = pickle.loads(
+                    results.get(True, self.POLL_INTERVAL))
+            except Queue.Empty:
+                # A process that died without reporting anything must have crashed
+                for position, process in running.iteritems():
+                    if not process.is_alive() and process.exitcode != 0:
+                        log.warning("Process {0!s} died with exit code {1!s}.", process.pid,
+                                    process.exitcode)
+                        return (position, False, None)
+                continue
+
+            # Ignore any stragglers from processes we've already given up on
+            if position in running:
+                if events:
+                    profiler.get_profiler().add_events(events)
+                return (position, succeeded, result)
+
+    def run(self):
+        ordered = list(self.task_queue)
+        pending = range(len(ordered))
+        done = set()
+        failed = []
+        running = {}
+        results = multiprocessing.Queue()
+
+        while pending or running:
+            # Stop starting new tasks once anything has failed, but let running ones finish
+            if not failed:
+                for i in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if self._is_ready(ordered[i], done):
+                        pending.remove(i)
+                        running[i] = self._start(ordered, i, results)
+
+            if not running:
+                break
+
+            position, succeeded, result = self._wait_for_result(running, results)
+            running.pop(position).join()
+
+            task = ordered[position]
+            if succeeded:
+                task.import_result(result, self.config)
+                done.add(task)
+            else:
+                failed.append(task)
+
+        if failed:
+            log.fatal("{0!s} task(s) failed: {1!r}.", len(failed), [i.id for i in failed])
@@ -0,0 +1,137 @@
+# stdlib
+import tempfile
+
+# internal
+from . import profiler
+from . import utils
+
+# set up logging
+import phial.loggers
+log = phial.loggers.get_logger(__name__)
+
+
+class MemoryBudget(object):
+    """Limits how much memory the documents in a build may take up between them.
+
+    Documents are kept in memory until they grow too large (see :class:`BudgetedSpooledFile`).
+    Once keeping a document in memory would put every document together over ``max_size`` bytes
+    it spills to a temporary file in ``directory`` (or the system's temporary directory if that's
+    ``None``) instead.
+    """
+
+    def __init__(self, max_size, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+
+        self.resident = 0
+        self.peak_resident = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+
+    def reserve(self, amount):
+        """Return True and account for ``amount`` more bytes if they fit in the budget."""
+        if self.resident + amount > self.max_size:
+            return False
+
+        self.resident += amount
+        self.peak_resident = max(self.peak_resident, self.resident)
+        return True
+
+    def release(self, amount):
+        self.resident -= amount
+
+    def record_spill(self, size):
+        self.spills += 1
+        self.spilled_bytes += size
+        profiler.count("documents_spilled")
+        profiler.count("bytes_spilled", size)
+
+    def format_summary(self):
+        return "{0!s} document(s) spilled to disk ({1!s} bytes), at most {2!s} bytes in memory." \
+            .format(self.spills, self.spilled_bytes, self.peak_resident)
+
+
+class BudgetedSpooledFile(tempfile.SpooledTemporaryFile):
+    """A :class:`tempfile.SpooledTemporaryFile` whose memory is accounted for by a budget.
+
+    The file spills to disk once it grows past ``max_size`` bytes (as usual), or once ``budget``
+    can't spare the memory for it.
+    """
+
+    def __init__(self, budget, max_size=0, mode="w+b"):
+        # SpooledTemporaryFile is an old-style class, so no super() here
+        tempfile.SpooledTemporaryFile.__init__(self, max_size, mode, dir=budget.directory)
+        self._budget = budget
+        self._resident = 0
+
+    def _check(self, file):
+        if self._rolled:
+            return
+
+        # Seeking backwards and writing doesn't shrink the file, so we never shrink either
+        size = max(self._resident, file.tell())
+        if self._max_size and size > self._max_size:
+            self.rollover()
+        elif self._budget.reserve(size - self._resident):
+            self._resident = size
+        else:
+            self.rollover()
+
+    def _release(self):
+        self._budget.release(self._resident)
+        self._resident = 0
+
+    def rollover(self):
+        if self._rolled:
+            return
+
+        size = len(self._file.getvalue())
+        tempfile.SpooledTemporaryFile.rollover(self)
+        self._release()
+        self._budget.record_spill(size)
+        log.debug("Spilled a {0!s} byte document to disk.", size)
+
+    def close(self):
+        self._release()
+        tempfile.SpooledTemporaryFile.close(self)
+
+    def __del__(self):
+        # Documents are rarely closed explicitly, most are just dropped
+        self._release()
+
+
+# The budget shared by every document in this build, see configure()
+_budget = None
+
+
+def configure(max_size, directory=None):
+    """Set up the budget that documents created by :func:`spooled_file` will share.
+
+    :param max_size: The most bytes documents may take up in memory, or ``None`` to only limit
+        the size of each individual document.
+    :param directory: Where documents that don't fit are spilled to, or ``None`` to use the
+        system's temporary directory.
+    """
+    global _budget
+    if max_size is None:
+        _budget = None
+    else:
+        if directory is not None:
+            utils.makedirs(directory)
+        _budget = MemoryBudget(max_size, directory)
+
+
+def get_budget():
+    """Return the build's :class:`MemoryBudget`, or ``None`` if there isn't one."""
+    return _budget
+
+
+def spooled_file(max_size, mode="w+b"):
+    """Return a new temporary file that's kept in memory until it grows past ``max_size``.
+
+    If the build has a :class:`MemoryBudget` the file counts against it.
+    """
+    if _budget is None:
+        return tempfile.SpooledTemporaryFile(max_size=max_size, mode=mode)
+
+    return BudgetedSpooledFile(_budget, max_size, mode)
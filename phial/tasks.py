@@ -19,6 +19,18 @@ class Task(object):
     def run(self, config):
         pass
 
+    def export_result(self, config):
+        """Return whatever later tasks need to know about this task having run.
+
+        When tasks run in separate processes this is called in the process that ran the task and
+        its return value (which must be picklable) is given to :meth:`import_result` in the main
+        process.
+        """
+        return None
+
+    def import_result(self, result, config):
+        pass
+
 
 @utils.public
 class TaskQueue(object):
@@ -70,6 +82,9 @@ class TaskQueue(object):
     def enqueue(self, task):
         self._queue.append(task)
 
+    def clear(self):
+        del self._queue[:]
+
     def get_task(self, id):
         for i in self._queue:
             if i.id is id:
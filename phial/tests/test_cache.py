@@ -0,0 +1,47 @@
+# internal
+import phial.cache
+
+# stdlib
+import os
+
+
+class TestDiskCache:
+    def test_get_set(self, tmpdir):
+        cache = phial.cache.DiskCache(str(tmpdir), 1024)
+
+        assert cache.get("missing") is None
+        assert cache.get("missing", 3) == 3
+
+        cache.set("key", {"a": [1, 2]})
+        assert cache.get("key") == {"a": [1, 2]}
+
+        # Another instance should see the same entries
+        assert phial.cache.DiskCache(str(tmpdir), 1024).get("key") == {"a": [1, 2]}
+
+    def test_corrupt_entry(self, tmpdir):
+        cache = phial.cache.DiskCache(str(tmpdir), 1024)
+        cache.set("key", "value")
+        with open(cache._get_path("key"), "wb") as f:
+            f.write("garbage")
+
+        assert cache.get("key") is None
+        assert not os.path.exists(cache._get_path("key"))
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        value = "x" * 100
+        cache = phial.cache.DiskCache(str(tmpdir), 400)
+        for i, key in enumerate(["a", "b", "c"]):
+            cache.set(key, value)
+            os.utime(cache._get_path(key), (i, i))
+
+        # Using a makes b the least recently used entry
+        assert cache.get("a") == value
+        cache.set("d", value)
+
+        assert cache.get("b") is None
+        assert [cache.get(i) for i in ["a", "c", "d"]] == [value] * 3
+
+    def test_too_large(self, tmpdir):
+        cache = phial.cache.DiskCache(str(tmpdir), 10)
+        cache.set("key", "x" * 100)
+        assert cache.get("key") is None
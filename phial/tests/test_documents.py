@@ -1,8 +1,10 @@
 # internal
+import phial.cache
 import phial.documents
 
 # external
 import pytest
+import yaml
 
 # stdlib
 import StringIO
@@ -71,6 +73,36 @@ class TestDocuments:
         assert frontmatter == sample["frontmatter"]
         assert content.read() == sample["content"]
 
+    @pytest.mark.parametrize("sample", SAMPLE_FILES)
+    def test_frontmatter_parsing_cached(self, sample, tmpdir, monkeypatch):
+        phial.cache.configure(str(tmpdir), 1024 * 1024)
+        try:
+            for i in range(2):
+                frontmatter, content = phial.documents.parse_frontmatter(
+                    StringIO.StringIO(sample["raw"]))
+
+                assert frontmatter == sample["frontmatter"]
+                assert content.read() == sample["content"]
+
+                # The second time around everything should come out of the cache
+                monkeypatch.setattr(phial.documents, "_parse_frontmatter", None)
+        finally:
+            phial.cache.configure(None, 0)
+
+    @pytest.mark.skipif(not hasattr(phial.documents, "UnicodeSafeCLoader"),
+                        reason="PyYAML was built without libyaml.")
+    def test_loaders_agree(self):
+        raw = (
+            u"name: " + UNICODE_TEST_PONY + u"\n"
+            u"number: 5\n"
+            u"list: [a, 1.5, {nested: null}]\n"
+            u"date: 2014-01-01\n"
+        )
+
+        expected = yaml.load(raw, phial.documents.UnicodeSafeLoader)
+        assert yaml.load(raw, phial.documents.UnicodeSafeCLoader) == expected
+        assert expected["number"] == u"5"
+
     @pytest.mark.parametrize("encoding", TEST_ENCODINGS)
     def test_open_file(self, encoding):
         encoded_pony = encoding[1] + UNICODE_TEST_PONY.encode(encoding[0])
@@ -0,0 +1,65 @@
+# internal
+import phial.fastcopy
+import phial.pipelines
+
+# external
+import pytest
+
+# stdlib
+import os
+
+
+class TestCopyFile:
+    @pytest.mark.parametrize("method", phial.fastcopy.METHODS)
+    def test_copy(self, tmpdir, method):
+        source = tmpdir.join("source")
+        source.write("x" * (3 * 1024 * 1024 + 7), "wb")
+        destination = tmpdir.join("destination")
+
+        used = phial.fastcopy.copy_file(str(source), str(destination), method)
+
+        assert destination.read("rb") == source.read("rb")
+        if method == "copy":
+            assert used == "copy"
+        elif method == "hardlink":
+            assert used == "hardlink"
+            assert os.path.samefile(str(source), str(destination))
+
+    def test_empty(self, tmpdir):
+        source = tmpdir.join("source")
+        source.write("")
+        destination = tmpdir.join("destination")
+
+        phial.fastcopy.copy_file(str(source), str(destination))
+        assert destination.read() == ""
+
+
+class TestPassthrough:
+    def run_pipeline(self, tmpdir, function, copy_method):
+        task = phial.pipelines.PipelineTask(function, "assets/*", True, function)
+        task.run({"output": str(tmpdir.join("output")), "index": None,
+                  "copy_method": copy_method})
+
+    def test_passthrough_breaks_links(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        source = tmpdir.mkdir("assets").join("image.png")
+        source.write("\x89PNG", "wb")
+
+        def passthrough(source):
+            for i in source.contents:
+                i.read()
+            return source
+
+        def replace(source):
+            return source | phial.pipelines.map(
+                lambda f: phial.documents.file(name=f.name, content=u"replaced"))
+
+        self.run_pipeline(tmpdir, passthrough, "hardlink")
+        output = str(tmpdir.join("output", "assets", "image.png"))
+        assert os.path.samefile(str(source), output)
+        assert open(output, "rb").read() == "\x89PNG"
+
+        # Writing a different output mustn't write through the link into the input
+        self.run_pipeline(tmpdir, replace, "hardlink")
+        assert open(output, "rb").read() == "replaced"
+        assert source.read("rb") == "\x89PNG"
@@ -0,0 +1,116 @@
+# internal
+import phial.documents
+import phial.index
+import phial.pipelines
+import phial.tasks
+
+# stdlib
+import os
+
+
+class Build(object):
+    """Runs a small two task site against an index, recording how often each task runs."""
+
+    def __init__(self, tmpdir):
+        self.source_dir = tmpdir.mkdir("source")
+        self.output_dir = str(tmpdir.mkdir("output"))
+        self.index_path = os.path.join(self.output_dir, ".phial_index")
+        self.runs = {"upper": 0, "listing": 0}
+
+        self.source_dir.join("a.txt").write("a")
+        self.source_dir.join("b.txt").write("b")
+
+    def run(self, app_hash="app", changed_paths=None):
+        runs = self.runs
+
+        def make_upper(f):
+            text = f.read()
+            return phial.documents.file(name=os.path.basename(f.name), metadata={"title": text},
+                                        content=text.upper())
+
+        def upper(source):
+            runs["upper"] += 1
+            return source | phial.pipelines.map(make_upper)
+
+        def listing(source):
+            runs["listing"] += 1
+            titles = [i.metadata["title"] for i in queue.get_task(upper).files]
+            source.contents = [phial.documents.file(name="index.txt", content=u",".join(titles))]
+            return source
+
+        queue = phial.tasks.TaskQueue()
+        queue.enqueue(phial.pipelines.PipelineTask(
+            upper, str(self.source_dir.join("*.txt")), False, upper))
+        queue.enqueue(phial.pipelines.PipelineTask(
+            listing, [], False, listing, depends_on=upper))
+
+        index = phial.index.BuildIndex(self.index_path, self.output_dir, app_hash, changed_paths)
+        for i in queue:
+            i.run({"output": self.output_dir, "index": index})
+        index.remove_stale_outputs()
+        index.save()
+
+    def output(self, name):
+        return os.path.join(self.output_dir, name)
+
+
+class TestBuildIndex:
+    def test_unchanged_inputs_skip_task(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+        build.run()
+
+        assert build.runs == {"upper": 1, "listing": 2}
+        assert open(build.output("index.txt")).read() == "a,b"
+
+    def test_changed_input_reruns_task(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+        build.source_dir.join("b.txt").write("bee")
+        build.run()
+
+        assert build.runs["upper"] == 2
+        assert open(build.output("b.txt")).read() == "BEE"
+
+    def test_changed_paths(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+
+        # Only the paths we're told about are considered changed
+        build.source_dir.join("b.txt").write("bee")
+        build.run(changed_paths=set())
+        assert build.runs["upper"] == 1
+
+        build.run(changed_paths=set([str(build.source_dir)]))
+        assert build.runs["upper"] == 2
+        assert open(build.output("b.txt")).read() == "BEE"
+
+    def test_changed_app_reruns_task(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+        build.run(app_hash="new app")
+
+        assert build.runs["upper"] == 2
+
+    def test_identical_output_not_rewritten(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+        os.utime(build.output("index.txt"), (0, 0))
+        index = phial.index.BuildIndex(build.index_path, build.output_dir, "app")
+        index.record_output(build.output("index.txt"),
+                            phial.index.hash_path(build.output("index.txt")))
+        index.previous_outputs = index.outputs
+        index.save()
+
+        build.run()
+
+        assert os.stat(build.output("index.txt")).st_mtime == 0
+
+    def test_stale_outputs_removed(self, tmpdir):
+        build = Build(tmpdir)
+        build.run()
+        build.source_dir.join("b.txt").remove()
+        build.run()
+
+        assert os.path.exists(build.output("a.txt"))
+        assert not os.path.exists(build.output("b.txt"))
@@ -1,7 +1,15 @@
+# stdlib
+import os.path
+
 # internal
+import phial.cache
+import phial.loggers
 import phial.pipelines
 import phial.utils
 
+# external
+import pytest
+
 
 class TestPipeline:
     def test_concat(self):
@@ -70,3 +78,141 @@ class TestPipeline:
         ]
         phial.pipelines.PipelineSource(files) | phial.pipelines.map(transform, counter=True)
         assert counter["_scope_hack"] == 2
+
+    def test_map_workers(self):
+        def transform(f, index):
+            return phial.documents.file(f.name, metadata={"index": index},
+                                        content=f.read() + u"1")
+
+        names = [str(i) for i in range(20)]
+        files = [phial.documents.file(i, content=i) for i in names]
+        result = phial.pipelines.PipelineSource(files) | phial.pipelines.map(transform,
+                                                                             counter=True,
+                                                                             workers=3)
+
+        assert [i.name for i in result.contents] == names
+        assert [i.metadata["index"] for i in result.contents] == range(len(names))
+        assert [i.read() for i in result.contents] == [i + u"1" for i in names]
+
+    def test_map_streams(self):
+        produced = []
+
+        def documents():
+            for i in ["a", "b"]:
+                produced.append(i)
+                yield phial.documents.file(i, content=i)
+
+        result = phial.pipelines.PipelineSource(documents()) | phial.pipelines.map(lambda f: f)
+        assert produced == []
+
+        assert next(result.contents).read() == "a"
+        assert produced == ["a"]
+        assert [i.read() for i in result.contents] == ["b"]
+
+    def test_streaming_task(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        names = [str(i) for i in range(5)]
+        for i in names:
+            tmpdir.join("in", i).write(i, ensure=True)
+
+        def transform(f):
+            # Every earlier document should already have been written and closed
+            name = os.path.basename(f.name)
+            for i in names[:names.index(name)]:
+                assert tmpdir.join("out", i).read() == i + "!"
+            return phial.documents.file(name, content=f.read() + u"!")
+
+        def function(source):
+            assert not isinstance(source.contents, list)
+            return source | phial.pipelines.map(transform)
+
+        task = phial.pipelines.PipelineTask(function, "in/*", False, function, stream=True)
+        task.run({"output": str(tmpdir.join("out"))})
+
+        assert sorted(i.name for i in task.files) == names
+        assert all(i.read() == i.name + "!" for i in task.files)
+
+    def test_exec_streams(self):
+        content = u"\u00e9abc\n" * 100000
+        files = [phial.documents.file("a", content=content),
+                 phial.documents.file("b", content=u"!")]
+
+        source = phial.pipelines.PipelineSource(files) | phial.pipelines.run("joined", ["cat"])
+
+        assert source.contents[0].read() == content + u"!"
+
+    def test_exec_ignores_unread_input(self):
+        files = [phial.documents.file("a", content=u"x" * 1000000)]
+
+        source = phial.pipelines.PipelineSource(files) | phial.pipelines.run("out", ["true"])
+
+        assert source.contents[0].read() == u""
+
+    def test_run_each(self):
+        names = [str(i) for i in range(10)]
+        files = [phial.documents.file(i, metadata=i, content=u"\u00e9" + i) for i in names]
+
+        result = phial.pipelines.PipelineSource(files) | phial.pipelines.run_each(
+            ["sed", "s/$/!/"], workers=3)
+
+        assert [(i.name, i.metadata) for i in result.contents] == zip(names, names)
+        assert [i.read() for i in result.contents] == [u"\u00e9" + i + u"!" for i in names]
+
+    def test_run_each_binary(self):
+        files = [open(__file__, "rb")]
+
+        result = phial.pipelines.PipelineSource(files) | phial.pipelines.run_each(["cat"])
+
+        with open(__file__, "rb") as f:
+            assert result.contents[0].read() == f.read()
+
+    def test_run_each_retries(self, tmpdir):
+        # Fails the first time it's run and succeeds afterwards
+        marker = str(tmpdir.join("marker"))
+        args = ["sh", "-c", "if [ -e {0} ]; then cat; else touch {0}; exit 1; fi".format(marker)]
+        files = [phial.documents.file("a", content=u"a")]
+
+        result = phial.pipelines.PipelineSource(files) | phial.pipelines.run_each(args, retries=1)
+        assert result.contents[0].read() == u"a"
+
+    def test_run_each_timeout(self):
+        files = [phial.documents.file("a", content=u"a")]
+
+        with pytest.raises(phial.loggers.FatalError):
+            phial.pipelines.PipelineSource(files) | phial.pipelines.run_each(["sleep", "5"],
+                                                                             timeout=0.1)
+
+    def test_cached(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(phial.cache, "_cache", phial.cache.DiskCache(str(tmpdir), 1024 * 1024))
+        calls = []
+
+        @phial.pipelines.cached(version="1")
+        def transform(contents):
+            calls.append(len(contents))
+            return [phial.documents.file("out", metadata={"count": len(contents)},
+                                         content=u"".join(i.read() for i in contents))]
+
+        def build(*contents):
+            files = [phial.documents.file(str(i), content=c) for i, c in enumerate(contents)]
+            result = phial.pipelines.PipelineSource(files) | transform
+            return [(i.name, i.metadata, i.read()) for i in result.contents]
+
+        assert build(u"a", u"b") == [("out", {"count": 2}, u"ab")]
+        assert build(u"a", u"b") == [("out", {"count": 2}, u"ab")]
+        assert calls == [2]
+
+        build(u"a", u"c")
+        assert calls == [2, 2]
+
+        transform.version = "2"
+        build(u"a", u"c")
+        assert calls == [2, 2, 2]
+
+    def test_cached_without_cache(self, monkeypatch):
+        monkeypatch.setattr(phial.cache, "_cache", None)
+        files = [phial.documents.file("a", content=u"a")]
+
+        result = phial.pipelines.PipelineSource(files) | phial.pipelines.cached(
+            phial.pipelines.concat("joined"))
+
+        assert result.contents[0].read() == u"a"
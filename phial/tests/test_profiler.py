@@ -0,0 +1,64 @@
+# internal
+import phial.documents
+import phial.pipelines
+import phial.profiler
+
+# external
+import pytest
+
+# stdlib
+import json
+
+
+@pytest.fixture
+def build_profiler():
+    yield phial.profiler.enable(per_file=True)
+    phial.profiler._profiler = None
+
+
+class TestProfiler:
+    def test_pipeline(self, tmpdir, build_profiler):
+        def page(source):
+            source.contents = [phial.documents.file(name=i, content=i) for i in [u"a", u"b"]]
+            return source | phial.pipelines.map(lambda f: f) | phial.pipelines.concat("joined")
+
+        task = phial.pipelines.PipelineTask(page, [], False, "page")
+        task.run({"output": str(tmpdir), "index": None})
+
+        summary = dict(((i["category"], i["name"]), i) for i in build_profiler.get_summary(
+            ("task", "stage", "file")))
+        assert set(summary) == set([
+            ("task", "'page'"),
+            ("stage", "map(<lambda>)"),
+            ("stage", "concat"),
+            ("file", "a"),
+            ("file", "b"),
+        ])
+        assert summary[("task", "'page'")]["counters"] == {
+            "files_in": 0, "bytes_in": 0, "files_written": 1, "bytes_written": 2}
+        assert summary[("stage", "concat")]["counters"] == {
+            "documents_in": 2, "documents_out": 1}
+
+        # The task contains everything else, so it must have taken the longest
+        assert build_profiler.get_summary()[0]["category"] == "task"
+
+    def test_trace(self, tmpdir, build_profiler):
+        with phial.profiler.measure("outer", "task") as span:
+            span.add("files_written", 2)
+            with phial.profiler.measure("inner", "stage"):
+                pass
+
+        path = str(tmpdir.join("trace.json"))
+        build_profiler.write_trace(path)
+        events = json.load(open(path))["traceEvents"]
+
+        assert [i["name"] for i in events] == ["inner", "outer"]
+        assert all(i["ph"] == "X" for i in events)
+        assert events[1]["args"]["files_written"] == 2
+        assert events[1]["ts"] <= events[0]["ts"]
+        assert build_profiler.events[0]["parent"] == "outer"
+
+    def test_disabled(self):
+        with phial.profiler.measure("task", "task") as span:
+            span.add("files_written")
+            assert not span.enabled
@@ -0,0 +1,97 @@
+# internal
+import phial.rebuilds
+
+# stdlib
+import time
+
+
+class FakeWatcher(object):
+    """Gives out the changes it's given, one per wait."""
+
+    def __init__(self, *changes):
+        self.changes = list(changes)
+
+    def wait(self, timeout=None):
+        if self.changes:
+            return self.changes.pop(0)
+
+        assert timeout is not None, "Waiting forever."
+        time.sleep(timeout)
+        return set()
+
+
+class FakeBuild(object):
+    def __init__(self, changed_paths, succeeded=True):
+        self.changed_paths = changed_paths
+        self.succeeded = succeeded
+        self.finished = False
+        self.cancelled = False
+
+    def wait(self, timeout=None):
+        if self.cancelled or not self.finished:
+            return None
+        return self.succeeded
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def make_rebuilder(watcher, unbuilt_changes=frozenset()):
+    builds = []
+
+    def start_build(changed_paths):
+        builds.append(FakeBuild(changed_paths))
+        return builds[-1]
+
+    return phial.rebuilds.Rebuilder(watcher, start_build, 0.01, unbuilt_changes), builds
+
+
+class TestRebuilder:
+    def test_coalesces_changes(self):
+        rebuilder, builds = make_rebuilder(FakeWatcher(set(["a"]), set(["b"]), set(["c"])))
+        for i in range(4):
+            rebuilder.step()
+
+        assert [i.changed_paths for i in builds] == [set(["a", "b", "c"])]
+
+    def test_unknown_changes(self):
+        rebuilder, builds = make_rebuilder(FakeWatcher(set(["a"]), None))
+        for i in range(3):
+            rebuilder.step()
+
+        assert [i.changed_paths for i in builds] == [None]
+
+    def test_cancels_out_of_date_build(self):
+        watcher = FakeWatcher(set(["a"]))
+        rebuilder, builds = make_rebuilder(watcher)
+        rebuilder.step()
+        rebuilder.step()
+        assert len(builds) == 1
+
+        # The cancelled build's changes are given to the next one
+        watcher.changes.append(set(["b"]))
+        rebuilder.step()
+        assert builds[0].cancelled
+
+        rebuilder.step()
+        assert [i.changed_paths for i in builds] == [set(["a"]), set(["a", "b"])]
+
+        builds[1].finished = True
+        rebuilder.step()
+        assert rebuilder.build is None
+        assert rebuilder.unbuilt_changes == set()
+
+    def test_failed_build_changes_are_kept(self):
+        watcher = FakeWatcher(set(["a"]))
+        rebuilder, builds = make_rebuilder(watcher, set(["old"]))
+        rebuilder.step()
+        rebuilder.step()
+
+        builds[0].finished = True
+        builds[0].succeeded = False
+        rebuilder.step()
+
+        watcher.changes.append(set(["b"]))
+        rebuilder.step()
+        rebuilder.step()
+        assert [i.changed_paths for i in builds] == [set(["old", "a"]), set(["old", "a", "b"])]
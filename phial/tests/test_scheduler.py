@@ -0,0 +1,67 @@
+# internal
+import phial.documents
+import phial.loggers
+import phial.pipelines
+import phial.scheduler
+import phial.tasks
+
+# external
+import pytest
+
+# stdlib
+import os
+
+
+def make_queue(tasks):
+    queue = phial.tasks.TaskQueue()
+    for i in tasks:
+        queue.enqueue(i)
+    return queue
+
+
+def page_task(name, content, metadata=None, depends_on=None, function=None):
+    def page(source):
+        source.contents = [phial.documents.file(name=name, metadata=metadata,
+                                                content=function() if function else content)]
+        return source
+
+    return phial.pipelines.PipelineTask(page, [], False, name, depends_on)
+
+
+class TestParallelScheduler:
+    @pytest.mark.parametrize("jobs", [1, 2, 8])
+    def test_dependents_see_files(self, tmpdir, jobs):
+        def listing():
+            titles = []
+            for i in ["a", "b", "c"]:
+                titles += [f.metadata["title"] for f in queue.get_task(i).files]
+            return u",".join(titles)
+
+        queue = make_queue([
+            page_task("a", u"A", {"title": u"first"}),
+            page_task("b", u"B", {"title": u"second"}),
+            page_task("c", u"C", {"title": u"third"}),
+            page_task("index", None, depends_on=["a", "b", "c"], function=listing),
+        ])
+
+        output_dir = str(tmpdir)
+        phial.scheduler.run_tasks(queue, {"output": output_dir}, jobs)
+
+        assert open(os.path.join(output_dir, "index")).read() == "first,second,third"
+        document = queue.get_task("a").files[0]
+        document.seek(0)
+        assert document.read() == u"A"
+
+    def test_failure(self, tmpdir):
+        def explode():
+            raise ValueError("Boom")
+
+        queue = make_queue([
+            page_task("a", None, function=explode),
+            page_task("b", u"B", depends_on="a"),
+        ])
+
+        with pytest.raises(phial.loggers.FatalError):
+            phial.scheduler.run_tasks(queue, {"output": str(tmpdir)}, 2)
+
+        assert not os.path.exists(str(tmpdir.join("b")))
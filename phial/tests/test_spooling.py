@@ -0,0 +1,71 @@
+# internal
+import phial.documents
+import phial.profiler
+import phial.spooling
+
+# external
+import pytest
+
+
+@pytest.fixture
+def budget(tmpdir):
+    phial.spooling.configure(100, str(tmpdir.join("scratch")))
+    yield phial.spooling.get_budget()
+    phial.spooling.configure(None)
+
+
+class TestSpooling:
+    def test_spills_over_budget(self, budget):
+        first = phial.documents.file("a", content=u"x" * 60)
+        assert budget.resident == 60
+        assert budget.spills == 0
+
+        second = phial.documents.file("b", content=u"y" * 60)
+        assert budget.resident == 60
+        assert budget.spills == 1
+        assert budget.spilled_bytes == 60
+        assert budget.peak_resident == 60
+
+        # Spilling mustn't lose anything
+        assert first.read() == u"x" * 60
+        assert second.read() == u"y" * 60
+
+    def test_spills_to_scratch_dir(self, tmpdir, budget):
+        document = phial.spooling.spooled_file(10)
+        document.write("x" * 20)
+        assert document._rolled
+        assert tmpdir.join("scratch").check(dir=True)
+
+    def test_release(self, budget):
+        document = phial.documents.file("a", content=u"x" * 60)
+        document.close()
+        assert budget.resident == 0
+
+        document = phial.documents.file("a", content=u"x" * 60)
+        del document
+        assert budget.resident == 0
+
+    def test_rewriting_does_not_grow(self, budget):
+        document = phial.spooling.spooled_file(1000)
+        document.write("x" * 50)
+        document.seek(0)
+        document.write("y" * 50)
+        assert budget.resident == 50
+
+    def test_spool_size(self):
+        document = phial.documents.file("a", spool_size=10, content=u"x" * 20)
+        assert document.stream._rolled
+
+        document = phial.documents.file("a", content=u"x" * 20)
+        assert not document.stream._rolled
+
+    def test_profiler_counts_spills(self, budget):
+        build_profiler = phial.profiler.enable()
+        try:
+            with phial.profiler.measure("task", "task"):
+                phial.documents.file("a", content=u"x" * 200)
+        finally:
+            phial.profiler._profiler = None
+
+        assert build_profiler.events[0]["counters"] == {"documents_spilled": 1,
+                                                        "bytes_spilled": 200}
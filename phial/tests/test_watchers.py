@@ -0,0 +1,116 @@
+# internal
+import phial.watchers
+
+# external
+import pytest
+
+# stdlib
+import os
+
+
+def inotify_available():
+    try:
+        phial.watchers.InotifyWatcher([], []).close()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+@pytest.fixture(params=["inotify", "poll"])
+def make_watcher(request):
+    if request.param == "inotify" and not inotify_available():
+        pytest.skip("inotify is not available.")
+
+    watchers = []
+
+    def make(watch_list, dont_watch_list=()):
+        watcher = phial.watchers.create_watcher([str(i) for i in watch_list],
+                                                [str(i) for i in dont_watch_list], 0.01,
+                                                request.param)
+        watchers.append(watcher)
+        return watcher
+
+    yield make
+
+    for i in watchers:
+        i.close()
+
+
+def expected_change(*paths):
+    return set(str(i) for i in paths)
+
+
+class TestWatchers:
+    def test_modified_file(self, tmpdir, make_watcher):
+        path = tmpdir.join("a.txt")
+        path.write("a")
+        watcher = make_watcher([tmpdir])
+
+        os.utime(str(path), (0, 0))
+
+        assert watcher.wait(5) == expected_change(path)
+
+    def test_new_directory(self, tmpdir, make_watcher):
+        watcher = make_watcher([tmpdir])
+
+        tmpdir.mkdir("sub")
+        assert watcher.wait(5) == expected_change(tmpdir.join("sub"))
+
+        tmpdir.join("sub", "b.txt").write("b")
+        assert watcher.wait(5) == expected_change(tmpdir.join("sub", "b.txt"))
+
+    def test_dont_watch(self, tmpdir, make_watcher):
+        output = tmpdir.mkdir("output")
+        hidden = tmpdir.mkdir(".git")
+        watcher = make_watcher([tmpdir], [output])
+
+        output.join("index.htm").write("index")
+        hidden.join("HEAD").write("head")
+        assert watcher.wait(0.2) == set()
+
+    def test_timeout(self, tmpdir, make_watcher):
+        watcher = make_watcher([tmpdir])
+        assert watcher.wait(0.05) == set()
+
+
+class TestTreeSnapshot:
+    def test_diff(self, tmpdir):
+        tmpdir.join("a.txt").write("a")
+        tmpdir.join("b.txt").write("b")
+        snapshot = phial.watchers.TreeSnapshot([str(tmpdir)], [])
+        assert snapshot.refresh() == (set(), set(), set())
+
+        tmpdir.join("a.txt").write("aa")
+        tmpdir.join("b.txt").remove()
+        tmpdir.join("sub", "c.txt").write("c", ensure=True)
+
+        diff = snapshot.refresh()
+        assert diff.added == set([str(tmpdir.join("sub")), str(tmpdir.join("sub", "c.txt"))])
+        assert diff.removed == set([str(tmpdir.join("b.txt"))])
+        assert diff.modified == set([str(tmpdir.join("a.txt"))])
+
+    def test_reuses_listings(self, tmpdir, monkeypatch):
+        tmpdir.join("a.txt").write("a")
+        os.utime(str(tmpdir), (0, 0))
+        snapshot = phial.watchers.TreeSnapshot([str(tmpdir)], [])
+
+        scanned = []
+        scan_directory = phial.watchers.scan_directory
+        monkeypatch.setattr(phial.watchers, "scan_directory",
+                            lambda path: scanned.append(path) or scan_directory(path))
+
+        os.utime(str(tmpdir.join("a.txt")), (0, 0))
+        assert snapshot.refresh().modified == set([str(tmpdir.join("a.txt"))])
+        assert scanned == []
+
+        tmpdir.join("b.txt").write("b")
+        assert snapshot.refresh().added == set([str(tmpdir.join("b.txt"))])
+        assert scanned == [str(tmpdir)]
+
+    def test_state_token(self, tmpdir):
+        tmpdir.join("a.txt").write("a")
+        token = phial.watchers.get_state_token([str(tmpdir)], [])
+        assert phial.watchers.get_state_token([str(tmpdir)], []) == token
+
+        tmpdir.join("b.txt").write("b")
+        assert phial.watchers.get_state_token([str(tmpdir)], []) != token
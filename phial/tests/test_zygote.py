@@ -0,0 +1,68 @@
+# internal
+import phial.zygote
+
+# stdlib
+import os
+import sys
+import time
+
+
+APP = """
+import os
+with open(os.path.join(os.path.dirname(__file__), "imports.log"), "a") as f:
+    f.write("imported\\n")
+"""
+
+
+def record_build(app_path, options, changed_paths):
+    """Load the app like a real build would and note what we were given."""
+    import imp
+    imp.load_source("userapp", app_path)
+
+    with open(os.path.join(os.path.dirname(app_path), "builds.log"), "a") as f:
+        f.write("{0!r}\n".format(sorted(changed_paths)))
+
+    sys.exit(0 if "good" in changed_paths else 1)
+
+
+def sleep_or_record_build(app_path, options, changed_paths):
+    os.setpgrp()
+    while "sleep" in changed_paths:
+        time.sleep(1)
+
+    record_build(app_path, options, changed_paths)
+
+
+class TestZygote:
+    def test_builds(self, tmpdir):
+        app = tmpdir.join("app.py")
+        app.write(APP)
+
+        zygote = phial.zygote.Zygote(record_build, str(app), None)
+        try:
+            assert zygote.build(set(["good"]))
+            assert not zygote.build(set(["bad"]))
+        finally:
+            zygote.close()
+
+        assert tmpdir.join("builds.log").read() == "['good']\n['bad']\n"
+
+        # Once to preload and once for each build
+        assert tmpdir.join("imports.log").read() == "imported\n" * 3
+
+    def test_cancel(self, tmpdir):
+        app = tmpdir.join("app.py")
+        app.write(APP)
+
+        zygote = phial.zygote.Zygote(sleep_or_record_build, str(app), None)
+        try:
+            build = zygote.start_build(set(["sleep"]))
+            assert build.wait(0.1) is None
+
+            build.cancel()
+            assert build.wait() is False
+
+            # The zygote should carry on as usual
+            assert zygote.build(set(["good"]))
+        finally:
+            zygote.close()
@@ -1,10 +1,7 @@
 # stdlib
 from optparse import OptionParser, OptionGroup, Option
 import BaseHTTPServer
-import glob
-import hashlib
 import imp
-import itertools
 import logging
 import multiprocessing
 import os
@@ -15,9 +12,19 @@ import time
 import tempfile
 
 # internal
+from . import cache
+from . import documents
+from . import fastcopy
+from . import profiler
+from . import rebuilds
 from . import tasks
 from . import loggers
 from . import utils
+from . import index
+from . import scheduler
+from . import spooling
+from . import watchers
+from . import zygote
 
 log = loggers.get_logger(__name__)
 
@@ -45,6 +52,32 @@ def parse_arguments(args=sys.argv[1:]):
         help="The encoding to use when writing unicode strings to the filesystem. Defaults to "
              "%default."
     )
+    parser.add_option(
+        "-j", "--jobs", action="store", default=1, type="int", metavar="N",
+        help="The number of tasks to run at once. Each task runs in its own process as soon as "
+             "the tasks it depends on are finished. Defaults to %default."
+    )
+    parser.add_option(
+        "--copy-method", action="store", default="auto", type="choice",
+        choices=fastcopy.METHODS,
+        help="How to create output files from binary pipelines that pass input files through "
+             "unchanged. reflink shares the data with the input until either is modified (only "
+             "some filesystems support this), hardlink makes the output another name for the "
+             "input (so modifying one modifies the other), and copy copies the data. auto tries "
+             "reflinking then copying within the kernel. Defaults to %default."
+    )
+    parser.add_option(
+        "--memory-budget", action="store", default=256, type="float", metavar="MiB",
+        help="The most memory the documents created during a build may take up between them, "
+             "measured in mebibytes. Documents that don't fit are moved to temporary files. "
+             "Every process gets its own budget when using --jobs. 0 removes the limit. Defaults "
+             "to %default."
+    )
+    parser.add_option(
+        "--scratch-dir", action="store", metavar="PATH", type="path",
+        help="Where to put documents that don't fit in the memory budget. Defaults to the "
+             "system's temporary directory."
+    )
     parser.add_option(
         "-v", "--verbose", action="count", default=0,
         help="Raises the verbosity. -v enables info level messages, -vv enables debug level "
@@ -96,9 +129,30 @@ def parse_arguments(args=sys.argv[1:]):
         "--no-watch-defaults", action="store_false", default=True, dest="watch_defaults",
         help="Do not populate the watch list or the don't-watch list with the default items."
     )
+    monitor_options.add_option(
+        "--zygote", action="store_true", default=False,
+        help="If specified, builds will be forked from a long-lived process that has already "
+             "imported everything your application imports, rather than starting from scratch "
+             "each time. That process is restarted whenever a Python file changes."
+    )
+    monitor_options.add_option(
+        "--watch-method", action="store", default="auto", type="choice",
+        choices=["auto", "inotify", "poll"],
+        help="How to detect changes. inotify asks the kernel to tell us about changes as they "
+             "happen (only available on Linux), poll periodically checks every file in the "
+             "watch list. auto uses inotify if it's available. Defaults to %default."
+    )
+    monitor_options.add_option(
+        "--watch-quiet-period", action="store", default=0.2, type="float", metavar="SECONDS",
+        help="After a change, wait until nothing has changed for this long before rebuilding, "
+             "so that a burst of changes (such as checking out a branch) only causes one build. "
+             "A build that's running when something changes is cancelled and started again. "
+             "Measured in seconds. Defaults to %default."
+    )
     monitor_options.add_option(
         "--watch-poll-frequency", action="store", default="1",
-        help="The amount of time to wait in between polling for changes. Measured in seconds (can "
+        help="The amount of time to wait in between polling for changes (only used when "
+             "polling). Measured in seconds (can "
              "be a non-integer like 2.4, irrational numbers are not allowed). Defaults to "
              "%default."
     )
@@ -125,6 +179,32 @@ def parse_arguments(args=sys.argv[1:]):
              "issue. Defaults to %default."
     )
 
+    profile_options = OptionGroup(
+        parser, "Profiling Options",
+        "Phial can measure where the time goes in a build, per task, per pipeline stage, and "
+        "optionally per file."
+    )
+    parser.add_option_group(profile_options)
+    profile_options.add_option(
+        "--profile", action="store_true", default=False,
+        help="If specified, a summary of the time taken by every task and pipeline stage will be "
+             "printed after each build."
+    )
+    profile_options.add_option(
+        "--profile-files", action="store_true", default=False,
+        help="If specified, every document given to map (including those of foreach pages) is "
+             "measured as well. Implies --profile."
+    )
+    profile_options.add_option(
+        "--profile-json", action="store", metavar="PATH", type="path",
+        help="Write every measurement to PATH as JSON. Implies --profile."
+    )
+    profile_options.add_option(
+        "--profile-trace", action="store", metavar="PATH", type="path",
+        help="Write every measurement to PATH in Chrome's trace event format, which can be "
+             "viewed at chrome://tracing. Implies --profile."
+    )
+
     index_options = OptionGroup(
         parser, "Phial Index Options",
         "Phial will automatically delete any old files from the output directory. It needs to "
@@ -135,7 +215,6 @@ def parse_arguments(args=sys.argv[1:]):
     parser.add_option_group(index_options)
     index_options.add_option(
         "--index-path", action="store", default=".phial_index", dest="index_path", metavar="PATH",
-        type="path",
         help="Where to store the index file. This is a path relative to the output directory "
              "(though it can also be an absolute path outside of it). Defaults to %default."
     )
@@ -144,6 +223,13 @@ def parse_arguments(args=sys.argv[1:]):
         help="If specified, no index file will be created and Phial will not clean the output "
              "directory."
     )
+    index_options.add_option(
+        "--cache-size", action="store", default=256, type="float", metavar="MiB",
+        help="Phial caches the results of expensive work (like parsing frontmatter) next to the "
+             "index file, keyed by the contents of the files involved. This sets the most space "
+             "that cache may take up, measured in mebibytes, with 0 disabling it. No cache is "
+             "kept if there's no index. Defaults to %default."
+    )
 
     options, args = parser.parse_args(args)
 
@@ -175,111 +261,93 @@ def setup_logging(verbose):
         logging.warning("`-v` or `--verbose` specified more than 2 times.")
 
 
-def get_state_token(dir_paths, exceptions):
-    """Return unique hash of names and timestamps in the given directories.
-
-    This function will iterate through the names and timestamps on every file
-    in the given directories and return a unique hash of that information.
+def monitor(watch_list, dont_watch_list, wait_time, start_build, method="auto", quiet_period=0.2,
+            unbuilt_changes=frozenset()):
+    """Loop forever, rebuilding whenever a change is detected in the watch list.
 
-    If you take a token returned by this function and compare it to a token of
-    the same directories, they will only be different if a file was added or
-    removed, a file was updated, a file was renamed, or a directory was
-    added/removed/renamed.
-
-    Any item that exists in the exceptions list will be ignored. The format of
-    the exceptions list is the same as for dir_paths.
+    See :class:`phial.rebuilds.Rebuilder` for when builds are started and what ``start_build``
+    should do.
     """
-    def expand_globs(paths):
-        """Glob every path in paths and returns the resulting list."""
-        # This will turn [[1, 2], [1]] into [1, 2, 1] (flatten the list)
-        return itertools.chain.from_iterable(glob.glob(i)for i in paths)
-
-    def walk_many(paths):
-        """Generator that walks all the paths given."""
-        for i in paths:
-            for j in os.walk(i, topdown=True):
-                yield j
-
-    def prune_paths(paths, exceptions_set, root="."):
-        return [i for i in paths if os.path.abspath(os.path.join(root, i)) not in exceptions_set]
-
-    # Glob and get a canonical path for each of the exceptions
-    exceptions = expand_globs(exceptions)
-    exceptions = set(os.path.abspath(i) for i in exceptions)
-
-    # Prune the directory list of any exceptions
-    dir_paths = prune_paths(dir_paths, exceptions)
-
-    # Glob all the paths in the directory list
-    globbed_paths = expand_globs(dir_paths)
-
-    hasher = hashlib.md5()
-    for root, dirs, files in walk_many(globbed_paths):
-        # Setting topdown to True above allows us to modify the directory list
-        # in dirs. The walk function will visit each item in the order in which
-        # they appear in that list. So here we sort it to make sure that the
-        # order in which they are visited is well defined, we also make sure
-        # that none of the directories are in our exceptions list or hidden.
-        # Note that we need to do slice assignment to ensure that we're
-        # affecting the original list.
-        dirs[:] = prune_paths(dirs, exceptions, root)
-        dirs[:] = [i for i in dirs if not i.startswith(".")]
-        dirs.sort()
-
-        # Create a list of the directory's absolute paths (this is a list
-        # comprehension below if you are unfamiliar with the construct).
-        absolute_dirs = [os.path.join(root, i) for i in dirs]
-
-        # Get a hash of that list (note that in Python you cannot take a hash
-        # of a list because it is mutable so we first convert the list to a
-        # tuple).
-        dirs_hash = hash(tuple(absolute_dirs))
-
-        # Add that hash into our final hash (after converting it to a string
-        # because it was an integer before).
-        hasher.update(str(dirs_hash))
-
-        # Iterate through all the files in sorted order (so we always visit
-        # them in the same order between different runs of this function).
-        for i in sorted(prune_paths(files, exceptions)):
-            # Get the absolute path of the file
-            cur_file_path = os.path.join(root, i)
-
-            # Add the aboslute path of the file to the final hash
-            hasher.update(cur_file_path)
-
-            # Add the last modified time of the file to the final hash
-            hasher.update(str(os.stat(cur_file_path).st_mtime))
-
-    return hasher.digest()
-
-
-def monitor(watch_list, dont_watch_list, wait_time, callback):
-    """Loop forever and run callback whenever a change is detected in the watch list."""
     log.info("Entering monitor mode. Watch list: {0!r}. Don't watch list: {1!r}.", watch_list,
              dont_watch_list)
 
-    old_token = get_state_token(watch_list, dont_watch_list)
+    watcher = watchers.create_watcher(watch_list, dont_watch_list, wait_time, method)
+    log.debug("Watching for changes with {0}.", watcher.__class__.__name__)
 
-    while True:
-        while True:
-            time.sleep(wait_time)
+    rebuilder = rebuilds.Rebuilder(watcher, start_build, quiet_period, unbuilt_changes)
+    try:
+        rebuilder.run()
+    finally:
+        rebuilder.cancel()
+        watcher.close()
+
+
+def code_may_have_changed(changed_paths):
+    """Return True if any Python code may be among ``changed_paths``."""
+    return changed_paths is None or any(i.endswith(".py") for i in changed_paths)
+
+
+def load_index(app_path, options, changed_paths=None):
+    """Return the index for this build, or None if the user doesn't want one."""
+    if options.index_path is None:
+        return None
+
+    # We can't tell which tasks a change to Python code affects
+    if code_may_have_changed(changed_paths):
+        changed_paths = None
+
+    result = index.BuildIndex(options.index_path, options.output, index.hash_path(app_path),
+                              changed_paths)
+
+    # Assign every task its key up front so keys don't depend on the order tasks finish in when
+    # running in parallel.
+    for i in tasks.global_queue:
+        result.get_key(i)
+
+    return result
+
+
+def configure_build(app_path, options, changed_paths=None):
+    """Set up the index, cache and profiler for a build and return the config given to tasks."""
+    config = dict(vars(options), index=load_index(app_path, options, changed_paths))
+
+    if options.index_path is not None and options.cache_size > 0:
+        cache.configure(options.index_path + "_cache", int(options.cache_size * 1024 * 1024))
+
+    if options.memory_budget > 0:
+        spooling.configure(int(options.memory_budget * 1024 * 1024), options.scratch_dir)
+    else:
+        spooling.configure(None)
 
-            current_token = get_state_token(watch_list, dont_watch_list)
-            if old_token != current_token:
-                break
-        old_token = current_token
+    if options.profile:
+        profiler.enable(options.profile_files)
 
-        log.info("Detected change in source files, rebuilding...")
+    return config
 
-        callback()
 
+def report_profile(options):
+    build_profiler = profiler.get_profiler()
 
-def build_app(app_path, options):
+    # Print to stdout to ensure the user always recieves the summary
+    print build_profiler.format_summary()
+
+    if options.profile_json:
+        build_profiler.write_json(options.profile_json)
+        log.info("Wrote profile to {0}.", options.profile_json)
+
+    if options.profile_trace:
+        build_profiler.write_trace(options.profile_trace)
+        log.info("Wrote profile trace to {0}.", options.profile_trace)
+
+
+def build_app(app_path, options, changed_paths=None):
     """Build the app.
 
     Will import the application in the current process so the foring version of this function is
     probably what you want.
+
+    If ``changed_paths`` is given, only tasks reading those paths (and the tasks that depend on
+    them) will be run, as long as there's an index to restore the other tasks from.
     """
     app_dir = os.path.dirname(app_path)
     os.chdir(app_dir)
@@ -298,6 +366,7 @@ def build_app(app_path, options):
     try:
         log.info("Building application from sources in {0} to output directory {1}.",
                  app_dir, options.output)
+        log.debug("Parsing frontmatter with {0}.", documents.FRONTMATTER_LOADER.__name__)
 
         try:
             utils.makedirs(options.output)
@@ -305,32 +374,93 @@ def build_app(app_path, options):
             log.debug("Ignoring error creating output directory at {0}.", options.output,
                       exc_info=True, exc_ignored=True)
 
+        config = configure_build(app_path, options, changed_paths)
+
         log.debug("About to consume queue: {0!r}", list(tasks.global_queue))
-        for i in tasks.global_queue:
-            i.run(vars(options))
+        scheduler.run_tasks(tasks.global_queue, config, options.jobs)
+
+        if spooling.get_budget() is not None:
+            log.debug("Memory budget: {0}", spooling.get_budget().format_summary())
+
+        if options.profile:
+            report_profile(options)
+
+        if config["index"] is not None:
+            config["index"].remove_stale_outputs()
+            config["index"].save()
     except Exception as e:
         show_tb = not isinstance(e, loggers.FatalError)
         log.warning("Failed to build app.", exc_info=show_tb)
 
+        # Let whoever forked us know, so they don't assume the index is up to date
+        sys.exit(1)
+
 
-def fork_and_build_app(*args, **kwargs):
-    """Fork a new process and builds the app."""
-    p = multiprocessing.Process(target=build_app, args=args, kwargs=kwargs)
+def build_app_in_process_group(*args, **kwargs):
+    """Call :func:`build_app` as the leader of a new process group.
 
-    # This will make sure Python tries to kill the process when it comes down
-    # in case anything goes wrong.
-    p.daemon = True
+    This lets the build be cancelled along with every process it starts.
+    """
+    os.setpgrp()
+    build_app(*args, **kwargs)
 
-    log.debug("Forking to build app. Passings args {0!r} and kwargs {1!r} to build_app().", args,
-              kwargs)
-    p.start()
 
-    # Wait for the process to terminate
-    p.join()
+class BuildProcess(object):
+    """A build running in a forked process.
+
+    Arguments are passed along to :func:`build_app`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._succeeded = None
+        self.process = multiprocessing.Process(target=build_app_in_process_group, args=args,
+                                               kwargs=kwargs)
+
+        # We'd like to make this a daemon so Python tries to kill the process when
+        # it comes down in case anything goes wrong, but daemonic processes can't
+        # have children of their own, which parallel builds need.
+        self.process.daemon = False
+
+        log.debug("Forking to build app. Passings args {0!r} and kwargs {1!r} to build_app().",
+                  args, kwargs)
+        self.process.start()
 
-    log.debug("Forked process finished, exit code {0!s}.", p.exitcode)
-    if p.exitcode != 0:
-        log.warning("Failed to build site.")
+    def wait(self, timeout=None):
+        """Wait for the build to finish, returning True if it succeeded.
+
+        ``None`` is returned instead if it's still running after ``timeout`` seconds.
+        """
+        if self._succeeded is None:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                return None
+
+            log.debug("Forked process finished, exit code {0!s}.", self.process.exitcode)
+            self._succeeded = self.process.exitcode == 0
+            if not self._succeeded:
+                log.warning("Failed to build site.")
+
+        return self._succeeded
+
+    def cancel(self):
+        if self._succeeded is None:
+            utils.kill_process_group(self.process.pid)
+            self.process.join()
+            self._succeeded = False
+
+
+def fork_and_build_app(*args, **kwargs):
+    """Fork a new process and builds the app.
+
+    Returns True if the build succeeded.
+    """
+    build = BuildProcess(*args, **kwargs)
+    try:
+        return build.wait()
+    finally:
+        # Only does anything if we were interrupted, the build is in its own process group so it
+        # won't have been interrupted along with us.
+        build.cancel()
 
 
 def fork_and_serve(public_dir, host, port, verbose):
@@ -397,6 +527,14 @@ def _main(options, arguments, deletion_list):  # noqa
         log.info("Created temporary directory at {0}.", temp_dir)
         options.output = temp_dir
 
+    if options.profile_files or options.profile_json or options.profile_trace:
+        options.profile = True
+
+    if options.index_path is not None:
+        # The index path is relative to the output directory (joining with an absolute path
+        # leaves it untouched).
+        options.index_path = os.path.join(options.output, options.index_path)
+
     watch_list = list(options.watch_list)
     dont_watch_list = list(options.dont_watch_list)
     if options.watch_defaults:
@@ -410,13 +548,27 @@ def _main(options, arguments, deletion_list):  # noqa
 
         dont_watch_list.append(options.output)
 
-    # We'll pass this callback function to our monitor routine
-    def callback():
-        fork_and_build_app(app_path, options)
+    build_zygote = None
+    if options.monitor and options.zygote:
+        build_zygote = zygote.Zygote(build_app_in_process_group, app_path, options)
+
+    def start_build(changed_paths):
+        if build_zygote is None:
+            return BuildProcess(app_path, options, changed_paths)
+
+        if code_may_have_changed(changed_paths):
+            log.debug("Python code may have changed, restarting the zygote.")
+            build_zygote.restart()
+
+        return build_zygote.start_build(changed_paths)
 
     # Build the app before we go into monitor mode, also takes care of building
     # it if we're not going into monitor mode at all.
-    callback()
+    first_build = start_build(None)
+    try:
+        succeeded = first_build.wait()
+    finally:
+        first_build.cancel()
 
     if options.serve:
         # This will fork off a web server and return immediately
@@ -424,8 +576,15 @@ def _main(options, arguments, deletion_list):  # noqa
                        options.verbose)
 
     if options.monitor:
-        # This function never returns
-        monitor(watch_list, dont_watch_list, float(options.watch_poll_frequency), callback)
+        # This function never returns. If the first build failed the next one has to build
+        # everything.
+        try:
+            monitor(watch_list, dont_watch_list, float(options.watch_poll_frequency),
+                    start_build, options.watch_method, options.watch_quiet_period,
+                    set() if succeeded else None)
+        finally:
+            if build_zygote is not None:
+                build_zygote.close()
 
     # If the user wants to serve the site but didn't enable monitoring we'd
     # exit immediately if we didn't do this.
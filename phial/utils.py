@@ -1,6 +1,10 @@
 # stdlib
+import ctypes
+import ctypes.util
+import errno
 import glob
 import os.path
+import signal
 import sys
 
 
@@ -81,3 +85,38 @@ def makedirs(path):
 @public
 def swap_extension(path, new_extension):
     return os.path.splitext(path)[0] + new_extension
+
+
+_libc = None
+
+
+def load_libc():
+    """Return the C library, loaded with ctypes.
+
+    An OSError will be raised if we're not on Linux or the library can't be loaded. Functions are
+    looked up lazily by ctypes, so callers should be ready for an AttributeError if the library is
+    too old to have what they need.
+    """
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "Only the Linux C library is supported.")
+
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    return _libc
+
+
+def kill_process_group(pid, sig=signal.SIGTERM):
+    """Send ``sig`` to the process group led by ``pid``, along with everything in it.
+
+    If the process hasn't made itself the leader of a group yet it can't have started any other
+    processes, so just it is signalled. Nothing happens if it has already exited.
+    """
+    for kill in (os.killpg, os.kill):
+        try:
+            kill(pid, sig)
+            return
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
@@ -0,0 +1,418 @@
+# stdlib
+import collections
+import ctypes
+import errno
+import glob
+import hashlib
+import itertools
+import os
+import select
+import stat
+import struct
+import sys
+import time
+
+# internal
+from . import loggers
+from . import utils
+
+log = loggers.get_logger(__name__)
+
+
+try:
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+def expand_globs(paths):
+    """Glob every path in paths and return the resulting set of absolute paths."""
+    return set(os.path.abspath(i) for i in itertools.chain.from_iterable(glob.glob(j)
+                                                                         for j in paths))
+
+
+def scan_directory(path):
+    """Return ``(files, dirs)``, the names of the entries in a directory split by type.
+
+    Uses ``scandir`` when it's available (it's built into Python 3.5 and up, and available as the
+    ``scandir`` package otherwise) so entries' types usually come for free with the listing.
+    Symbolic links to directories count as files.
+    """
+    files = []
+    dirs = []
+    if _scandir is not None:
+        for i in _scandir(path):
+            if i.is_dir(follow_symlinks=False):
+                dirs.append(i.name)
+            else:
+                files.append(i.name)
+    else:
+        for i in os.listdir(path):
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(os.path.join(path, i)).st_mode)
+            except OSError:
+                # It was removed after we listed it
+                continue
+
+            if is_dir:
+                dirs.append(i)
+            else:
+                files.append(i)
+
+    return (files, dirs)
+
+
+TreeDiff = collections.namedtuple("TreeDiff", ["added", "removed", "modified"])
+
+
+class TreeSnapshot(object):
+    """A record of every file (and unhidden directory) under a watch list, kept in memory.
+
+    Calling :meth:`refresh` brings the snapshot up to date and returns what changed since the
+    last time. Each directory's listing is remembered along with its modification time, which
+    only changes when entries are added, removed, or renamed, so unchanged directories don't need
+    to be listed again. Files still need to be stat'd every time to catch modifications.
+
+    Hidden directories and anything in ``dont_watch_list`` are skipped.
+    """
+
+    # A directory modified this recently (in seconds) may be modified again without its
+    # modification time changing, so its listing isn't trusted on the next refresh.
+    RACY_WINDOW = 1.0
+
+    def __init__(self, watch_list, dont_watch_list):
+        self.watch_list = watch_list
+        self.dont_watch_list = dont_watch_list
+
+        # Maps paths to (mtime, size)
+        self.files = {}
+
+        # Maps directory paths to (mtime, files, dirs), mtime is None if it can't be trusted
+        self.directories = {}
+
+        self.refresh()
+
+    def _list_directory(self, path, start_time):
+        """Return ``(mtime, files, dirs)`` for a directory, reusing our last listing if we can."""
+        mtime = os.stat(path).st_mtime
+
+        previous = self.directories.get(path)
+        if previous is not None and previous[0] == mtime:
+            return previous
+
+        files, dirs = scan_directory(path)
+        if mtime > start_time - self.RACY_WINDOW:
+            mtime = None
+
+        return (mtime, files, dirs)
+
+    def _scan_tree(self, root, exceptions, start_time, files, directories):
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                listing = self._list_directory(path, start_time)
+            except OSError:
+                # It was removed (or replaced with a file) while we were scanning
+                continue
+            directories[path] = listing
+
+            for i in listing[1]:
+                file_path = os.path.join(path, i)
+                if file_path in exceptions:
+                    continue
+
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    continue
+                files[file_path] = (file_stat.st_mtime, file_stat.st_size)
+
+            for i in listing[2]:
+                dir_path = os.path.join(path, i)
+                if not i.startswith(".") and dir_path not in exceptions:
+                    stack.append(dir_path)
+
+    def refresh(self):
+        """Update the snapshot and return a :class:`TreeDiff` of the paths that changed."""
+        start_time = time.time()
+        exceptions = expand_globs(self.dont_watch_list)
+
+        files = {}
+        directories = {}
+        for i in expand_globs(self.watch_list) - exceptions:
+            if os.path.isdir(i):
+                self._scan_tree(i, exceptions, start_time, files, directories)
+            else:
+                try:
+                    file_stat = os.stat(i)
+                except OSError:
+                    continue
+                files[i] = (file_stat.st_mtime, file_stat.st_size)
+
+        old_paths = set(self.files).union(self.directories)
+        new_paths = set(files).union(directories)
+        diff = TreeDiff(
+            added=new_paths - old_paths,
+            removed=old_paths - new_paths,
+            modified=set(i for i, j in files.iteritems() if self.files.get(i, j) != j))
+
+        self.files = files
+        self.directories = directories
+        return diff
+
+
+def get_state_token(dir_paths, exceptions):
+    """Return a token that changes whenever anything in the given directories changes.
+
+    If you take a token returned by this function and compare it to a token of
+    the same directories, they will only be different if a file was added or
+    removed, a file was updated, a file was renamed, or a directory was
+    added/removed/renamed.
+
+    Any item that exists in the exceptions list will be ignored. The format of
+    the exceptions list is the same as for dir_paths. Use :class:`TreeSnapshot` directly to find
+    out what changed rather than only whether something did.
+    """
+    snapshot = TreeSnapshot(dir_paths, exceptions)
+    return hashlib.sha1(repr((sorted(snapshot.files.iteritems()),
+                              sorted(snapshot.directories)))).digest()
+
+
+class PollingWatcher(object):
+    """Detects changes by periodically refreshing a :class:`TreeSnapshot`.
+
+    This works everywhere, but has to look at every file in the watch list on every poll.
+    """
+
+    def __init__(self, watch_list, dont_watch_list, poll_frequency):
+        self.watch_list = watch_list
+        self.dont_watch_list = dont_watch_list
+        self.poll_frequency = poll_frequency
+        self.snapshot = TreeSnapshot(watch_list, dont_watch_list)
+        self._next_poll = time.time() + poll_frequency
+
+    def wait(self, timeout=None):
+        """Block until something changes or ``timeout`` seconds have passed.
+
+        We never poll more often than ``poll_frequency``, however short the timeout.
+
+        :returns: The set of paths that changed, or an empty set if we timed out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            if now >= self._next_poll:
+                self._next_poll = now + self.poll_frequency
+
+                diff = self.snapshot.refresh()
+                changed = diff.added | diff.removed | diff.modified
+                if changed:
+                    return changed
+
+            if deadline is not None and now >= deadline:
+                return set()
+
+            wake_time = self._next_poll if deadline is None else min(self._next_poll, deadline)
+            time.sleep(max(0, wake_time - now))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Detects changes using Linux's inotify API.
+
+    Every unhidden directory under the watch list (except those in the don't-watch list) gets a
+    watch, and the kernel tells us as soon as anything in them changes. Directories created later
+    are watched as they appear, and the watch list is re-globbed every time we wait.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    WATCH_MASK |= IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    # struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+    EVENT_HEADER = struct.Struct("iIII")
+
+    READ_SIZE = 64 * 1024
+
+    @staticmethod
+    def _get_libc():
+        libc = utils.load_libc()
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+
+    def __init__(self, watch_list, dont_watch_list):
+        self.watch_list = watch_list
+        self.dont_watch_list = dont_watch_list
+
+        self._libc = self._get_libc()
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # Maps watch descriptors to the paths they watch and back
+        self._paths = {}
+        self._descriptors = {}
+
+        self._watch_roots(expand_globs(self.dont_watch_list))
+
+    def _add_watch(self, path):
+        if path in self._descriptors:
+            return
+
+        encoded_path = path
+        if isinstance(path, unicode):
+            encoded_path = path.encode(sys.getfilesystemencoding())
+
+        descriptor = self._libc.inotify_add_watch(self._fd, encoded_path, self.WATCH_MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+
+            # The path may have disappeared before we got to it, which is fine
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(error, "Could not watch {0}: {1}".format(path, os.strerror(error)))
+
+        self._paths[descriptor] = path
+        self._descriptors[path] = descriptor
+
+    def _watch_tree(self, root, exceptions):
+        if root in exceptions:
+            return
+
+        self._add_watch(root)
+        for dirpath, dirs, files in os.walk(root, topdown=True):
+            dirs[:] = [i for i in dirs if not i.startswith(".")]
+            dirs[:] = [i for i in dirs if os.path.join(dirpath, i) not in exceptions]
+            for i in dirs:
+                self._add_watch(os.path.join(dirpath, i))
+
+    def _watch_roots(self, exceptions):
+        for i in expand_globs(self.watch_list):
+            if i not in self._descriptors:
+                self._watch_tree(i, exceptions)
+
+    def _is_excluded(self, path, exceptions):
+        while True:
+            if path in exceptions:
+                return True
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def _read_events(self):
+        """Yield ``(path, mask)`` for every event that is waiting to be read."""
+        while True:
+            try:
+                data = os.read(self._fd, self.READ_SIZE)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+
+                if mask & self.IN_IGNORED:
+                    path = self._paths.pop(descriptor, None)
+                    self._descriptors.pop(path, None)
+                    continue
+
+                path = self._paths.get(descriptor)
+                if path is not None and name:
+                    path = os.path.join(path, name)
+
+                if path is not None or mask & self.IN_Q_OVERFLOW:
+                    yield (path, mask)
+
+    def _collect_changes(self, exceptions):
+        """Return the set of changed paths among the waiting events, or None on overflow."""
+        changed = set()
+        for path, mask in self._read_events():
+            if mask & self.IN_Q_OVERFLOW:
+                log.debug("The inotify queue overflowed, can't tell what changed.")
+                return None
+
+            if self._is_excluded(path, exceptions):
+                continue
+
+            if mask & self.IN_ISDIR:
+                if os.path.basename(path).startswith("."):
+                    continue
+
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch_tree(path, exceptions)
+
+            changed.add(path)
+
+        return changed
+
+    def wait(self, timeout=None):
+        """Block until something changes or ``timeout`` seconds have passed.
+
+        :returns: The set of paths that changed, ``None`` if something changed but we can't say
+            what, or an empty set if we timed out.
+        """
+        exceptions = expand_globs(self.dont_watch_list)
+        self._watch_roots(exceptions)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            readable = select.select([self._fd], [], [], remaining)[0]
+            if not readable:
+                return set()
+
+            changed = self._collect_changes(exceptions)
+            if changed is None or changed:
+                return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(watch_list, dont_watch_list, poll_frequency, method="auto"):
+    """Return the best available watcher.
+
+    :param method: One of ``"inotify"``, ``"poll"``, or ``"auto"``, which uses inotify if it is
+        available and polling otherwise.
+    """
+    if method in ("auto", "inotify"):
+        try:
+            return InotifyWatcher(watch_list, dont_watch_list)
+        except (OSError, AttributeError):
+            if method == "inotify":
+                raise
+
+            log.info("Could not use inotify, falling back to polling.", exc_info=True,
+                     exc_ignored=True)
+
+    return PollingWatcher(watch_list, dont_watch_list, poll_frequency)
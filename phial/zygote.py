@@ -0,0 +1,163 @@
+# stdlib
+import imp
+import multiprocessing
+import os
+import sys
+
+# internal
+from . import loggers
+from . import tasks
+from . import utils
+
+log = loggers.get_logger(__name__)
+
+
+class Zygote(object):
+    """A long-lived process that builds are forked from.
+
+    When it starts, the zygote imports the user's application once so that every module it
+    imports (markdown, pygments, etc.) is already loaded, then forgets the application itself.
+    Each build is then run in a fresh process forked from the zygote, which only has to reload
+    the application module rather than everything it depends on.
+
+    Modules imported by the zygote are never reloaded, so it needs to be restarted whenever any
+    Python code may have changed.
+
+    :param target: The function to run for each build. It is called as
+        ``target(app_path, options, changed_paths)`` in a forked process, which should exit with
+        a non-zero exit code if the build fails.
+    """
+
+    # How long to wait for the zygote to exit when asked before killing it. Measured in seconds.
+    SHUTDOWN_TIMEOUT = 5
+
+    def __init__(self, target, app_path, options):
+        self.target = target
+        self.app_path = app_path
+        self.options = options
+        self._process = None
+        self._connection = None
+
+    def _preload(self):
+        os.chdir(os.path.dirname(self.app_path))
+        try:
+            imp.load_source("userapp", self.app_path)
+        except Exception:
+            # The build itself will report the problem properly
+            log.debug("Could not preload app at {0}.", self.app_path, exc_info=True,
+                      exc_ignored=True)
+
+        # Keep the application's dependencies but not the application, which each build will
+        # load for itself.
+        sys.modules.pop("userapp", None)
+        tasks.global_queue.clear()
+
+    def _serve(self, connection):
+        try:
+            self._preload()
+            log.debug("Zygote {0!s} is ready.", os.getpid())
+
+            while True:
+                changed_paths = connection.recv()
+                if changed_paths is StopIteration:
+                    break
+
+                # Builds may fork processes of their own, so this can't be a daemon
+                process = multiprocessing.Process(
+                    target=self.target, args=(self.app_path, self.options, changed_paths))
+                process.daemon = False
+                process.start()
+                connection.send(process.pid)
+                process.join()
+
+                connection.send(process.exitcode == 0)
+        except (KeyboardInterrupt, EOFError):
+            pass
+
+    def start(self):
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=self._serve, args=(child_connection, ))
+        self._process.daemon = False
+        self._process.start()
+        log.debug("Started zygote in process {0!s}.", self._process.pid)
+
+    def close(self):
+        if self._process is None:
+            return
+
+        try:
+            self._connection.send(StopIteration)
+        except IOError:
+            pass
+
+        self._process.join(self.SHUTDOWN_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+        self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def start_build(self, changed_paths=None):
+        """Start building the app in a process forked from the zygote.
+
+        :returns: A :class:`ZygoteBuild`.
+        """
+        if self._process is None or not self._process.is_alive():
+            self.restart()
+
+        try:
+            self._connection.send(changed_paths)
+            pid = self._connection.recv()
+        except (EOFError, IOError):
+            log.warning("Zygote {0!s} died unexpectedly.", self._process.pid)
+            self.close()
+            return ZygoteBuild(self, None, succeeded=False)
+
+        return ZygoteBuild(self, pid)
+
+    def build(self, changed_paths=None):
+        """Build the app in a process forked from the zygote, returning True on success."""
+        return self.start_build(changed_paths).wait()
+
+
+class ZygoteBuild(object):
+    """A build running in a process forked from a :class:`Zygote`."""
+
+    def __init__(self, zygote, pid, succeeded=None):
+        self.zygote = zygote
+        self.pid = pid
+        self._succeeded = succeeded
+
+    def wait(self, timeout=None):
+        """Wait for the build to finish, returning True if it succeeded.
+
+        ``None`` is returned instead if it's still running after ``timeout`` seconds.
+        """
+        if self._succeeded is None:
+            connection = self.zygote._connection
+            try:
+                if not connection.poll(timeout):
+                    return None
+                self._succeeded = connection.recv()
+            except (EOFError, IOError):
+                log.warning("The zygote died unexpectedly.")
+                self.zygote.close()
+                self._succeeded = False
+                return False
+
+            if not self._succeeded:
+                log.warning("Failed to build site.")
+
+        return self._succeeded
+
+    def cancel(self):
+        """Kill the build (the zygote itself is left alone)."""
+        if self._succeeded is None:
+            utils.kill_process_group(self.pid)
+            self.wait()